@@ -0,0 +1,656 @@
+import csv
+import hashlib
+import json
+import heapq
+import io
+import itertools
+import os
+import tempfile
+import time
+import uuid
+import zipfile
+
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from . import models, crud, schemas
+from .database import SessionLocal, GENE_EXPRESSION_STORAGE
+
+# rows fetched per round trip from a server-side cursor
+FETCH_ROWS = 10000
+
+# rows written to a CSV entry between flushes of the archive to the client
+BLOCK_ROWS = 1000
+
+# bump when the archive layout changes, so cached archives are rebuilt
+ARCHIVE_FORMAT = 2
+
+# finished archives are kept on local disk, least recently used first out
+ARCHIVE_CACHE_DIR = os.environ.get('ARCHIVE_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'respire_archive_cache')
+ARCHIVE_CACHE_MAX_BYTES = int(os.environ.get('ARCHIVE_CACHE_MAX_BYTES') or 10 * 1024 ** 3)
+
+# ARCHIVE_CACHE_DIR is a volume mounted in the API and the workers, so the API can serve job archives
+ARCHIVE_CACHE_SHARED = (os.environ.get('ARCHIVE_CACHE_SHARED') or 'false').lower() in ('1', 'true', 'yes')
+
+# job archives are kept out of eviction until fetched, or at most this many seconds
+ARCHIVE_PIN_SECONDS = int(os.environ.get('ARCHIVE_PIN_SECONDS') or 24 * 3600)
+
+
+class ZipStream(io.RawIOBase):
+    """Write-only, unseekable buffer that zipfile writes into and the response drains"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buffer += b
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def csv_blocks(header: List[str], rows: Iterable[list], block_rows: int = BLOCK_ROWS) -> Iterator[str]:
+    """Format rows as CSV text, a block of rows at a time
+
+    Args:
+        header (list[str]): Column names
+        rows (Iterable[list]): Row values
+        block_rows (int, optional): Rows per block. Defaults to BLOCK_ROWS.
+
+    Yields:
+        str: CSV text
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(header)
+
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % block_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def metadata_rows(db: Session, query: schemas.DataQuery) -> Tuple[List[str], Iterator[list]]:
+    """Sample metadata pivoted to one row per sample and one column per variable
+
+    Studies with sample documents are read from them, and studies loaded before the
+    documents existed from their sample rows. Both are streamed in sample order and
+    merged, one sample at a time.
+
+    Args:
+        db (Session): A database session
+        query (schemas.DataQuery): Selected studies and sample filters
+
+    Returns:
+        tuple[list[str], Iterator[list]]: Variable names, and rows of sample_accession followed by one value per variable
+    """
+    documented = crud.list_document_studies(db, query.study_accessions)
+    pivoted = sorted(set(query.study_accessions) - set(documented))
+
+    sources = []
+    if documented:
+        sources.append(document_values(db, query, documented))
+    if pivoted:
+        sources.append(sample_values(db, query, pivoted))
+
+    variables = sorted(set().union(*(v for v, _ in sources)))
+
+    def rows():
+        # a sample listed under more than one study keeps the first value of each variable
+        merged = heapq.merge(*(values for _, values in sources), key=lambda r: r[0])
+        for sample_accession, group in itertools.groupby(merged, key=lambda r: r[0]):
+            values = {}
+            for _, sample in group:
+                for variable, value in sample.items():
+                    values.setdefault(variable, value)
+            yield [sample_accession] + [values.get(v, '') for v in variables]
+
+    return variables, rows()
+
+
+def sample_order(db: Session, column):
+    """Order a query in python string order, so sources can be merged -- see crud.expression_query"""
+    return column.collate('C') if db.bind.dialect.name == 'postgresql' else column
+
+
+def sample_values(db: Session,
+                  query: schemas.DataQuery,
+                  study_accessions: List[str]) -> Tuple[List[str], Iterator[Tuple[str, dict]]]:
+    """Sample metadata pivoted from the sample rows, for studies without sample documents
+
+    Args:
+        db (Session): A database session
+        query (schemas.DataQuery): Samples and sample filters
+        study_accessions (list[str]): Studies to read
+
+    Returns:
+        tuple[list[str], Iterator[tuple]]: Variable names, and each sample_accession with its values by variable
+    """
+    conditions = [models.Sample.accession_number.in_(study_accessions)]
+    conditions += crud.sample_conditions(models.Sample.sample_accession,
+                                         study_accessions,
+                                         query.samples,
+                                         query.sample_filters)
+
+    variables = [r[0] for r in db.query(
+        models.Sample.variable
+    ).filter(
+        *conditions
+    ).distinct().order_by(
+        models.Sample.variable
+    )]
+
+    rows_query = db.query(
+        models.Sample.sample_accession,
+        models.Sample.variable,
+        models.Sample.value
+    ).filter(
+        *conditions
+    ).order_by(
+        sample_order(db, models.Sample.sample_accession), models.Sample.variable, models.Sample.id
+    ).yield_per(FETCH_ROWS)
+
+    def rows():
+        for sample_accession, group in itertools.groupby(rows_query, key=lambda r: r[0]):
+            values = {}
+            for _, variable, value in group:
+                # keep the first value when a variable is repeated
+                values.setdefault(variable, value)
+            yield sample_accession, values
+
+    return variables, rows()
+
+
+def document_values(db: Session,
+                    query: schemas.DataQuery,
+                    study_accessions: List[str]) -> Tuple[List[str], Iterator[Tuple[str, dict]]]:
+    """Sample metadata read from the per-sample documents maintained at ingest
+
+    Args:
+        db (Session): A database session
+        query (schemas.DataQuery): Samples and sample filters
+        study_accessions (list[str]): Studies to read, all with sample documents
+
+    Returns:
+        tuple[list[str], Iterator[tuple]]: Variable names, and each sample_accession with its values by variable
+    """
+    conditions = [models.SampleDocument.accession_number.in_(study_accessions)]
+    conditions += crud.sample_conditions(models.SampleDocument.sample_accession,
+                                         study_accessions,
+                                         query.samples,
+                                         query.sample_filters)
+
+    variables = crud.list_sample_variables(db, conditions)
+
+    rows_query = db.query(
+        models.SampleDocument.sample_accession,
+        models.SampleDocument.document
+    ).filter(
+        *conditions
+    ).order_by(
+        sample_order(db, models.SampleDocument.sample_accession), models.SampleDocument.accession_number
+    ).yield_per(FETCH_ROWS)
+
+    def rows():
+        for sample_accession, group in itertools.groupby(rows_query, key=lambda r: r[0]):
+            values = {}
+            for _, document in group:
+                for variable, value in (document or {}).items():
+                    values.setdefault(variable, value)
+            yield sample_accession, values
+
+    return variables, rows()
+
+
+def matrix_rows(db: Session, query: schemas.DataQuery) -> Tuple[List[str], Iterator[list]]:
+    """Gene expression values pivoted to one row per gene and one column per sample
+
+    Each study is read through its own server-side cursor in gene order and the
+    cursors are merged, so only one gene row is held in memory at a time. Gene,
+    sample and metadata filters are applied in the database.
+
+    Args:
+        db (Session): A database session
+        query (schemas.DataQuery): Selected studies, genes, samples and sample filters
+
+    Returns:
+        tuple[list[str], Iterator[list]]: Sample accessions, and rows of gene followed by one value per sample (None if missing)
+    """
+    samples = crud.list_expression_samples(db, query.study_accessions, query.samples, query.sample_filters)
+
+    accessions = sorted(set(query.study_accessions))
+    fetch_rows = max(FETCH_ROWS // max(len(accessions), 1), 100)
+    cursors = [
+        crud.expression_query(db, [accession],
+                              ordered=True,
+                              genes=query.genes,
+                              samples=query.samples,
+                              sample_filters=query.sample_filters).yield_per(fetch_rows)
+        for accession in accessions
+    ]
+
+    def rows():
+        merged = heapq.merge(*cursors, key=lambda r: r[0])
+        for gene, group in itertools.groupby(merged, key=lambda r: r[0]):
+            values = {sample_accession: value for _, sample_accession, value in group}
+            yield [gene] + [values.get(s) for s in samples]
+
+    return samples, rows()
+
+
+def metadata_csv_blocks(db: Session, query: schemas.DataQuery) -> Iterator[str]:
+    """metadata.csv -- see metadata_rows"""
+    variables, rows = metadata_rows(db, query)
+    yield from csv_blocks(['sample_accession'] + variables, rows)
+
+
+def data_csv_blocks(db: Session, query: schemas.DataQuery) -> Iterator[str]:
+    """data_compendium.csv -- see matrix_rows"""
+    samples, rows = matrix_rows(db, query)
+    yield from csv_blocks(['gene'] + samples, rows)
+
+
+#########################
+# columnar formats
+#########################
+
+# file extension of each download format
+DOWNLOAD_FORMATS = {
+    'csv': 'csv',
+    'parquet': 'parquet',
+    'feather': 'feather',
+    'hdf5': 'h5'
+}
+
+# values per parquet row group / arrow record batch / hdf5 append -- 64 MB of float32,
+# so a block holds fewer genes the more samples there are
+GENE_BLOCK_CELLS = 16 * 1024 * 1024
+
+# hdf5 chunk of the matrix -- about 1 MB, so reading one gene or one sample stays cheap
+HDF5_CHUNK_ROWS = 64
+HDF5_CHUNK_COLUMNS = 4096
+
+
+def check_format(format: str):
+    """Raise ValueError if a download format is unknown or its libraries are not installed"""
+    if format not in DOWNLOAD_FORMATS:
+        raise ValueError(f"Unknown format '{format}', expected one of {', '.join(DOWNLOAD_FORMATS)}")
+
+    modules = {'parquet': 'pyarrow.parquet', 'feather': 'pyarrow.ipc', 'hdf5': 'tables'}
+    if format in modules:
+        try:
+            __import__(modules[format])
+        except ImportError:
+            raise ValueError(f"Format '{format}' needs the {modules[format].split('.')[0]} package")
+
+
+def to_float(value) -> Optional[float]:
+    """Expression values are stored as text in the default layout"""
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def gene_blocks(rows: Iterator[list], n_samples: int, block_cells: int = GENE_BLOCK_CELLS) -> Iterator[tuple]:
+    """Group matrix rows into blocks of genes and a float32 genes x samples array
+
+    Each row is converted straight into a preallocated array, missing and non-numeric
+    values as NaN, so a block takes about block_cells * 4 bytes whatever its shape.
+    """
+    import numpy as np
+
+    block_rows = max(1, block_cells // max(n_samples, 1))
+    while True:
+        genes = []
+        values = np.empty((block_rows, n_samples), dtype='float32')
+        for i, row in enumerate(itertools.islice(rows, block_rows)):
+            genes.append(row[0])
+            values[i] = [to_float(v) for v in row[1:]]
+        if len(genes) == 0:
+            return
+        yield genes, values[:len(genes)]
+
+
+def write_matrix(path: str, format: str, samples: List[str], rows: Iterator[list]):
+    """Write the gene x sample matrix with float32 columns, one block of genes at a time
+
+    HDF5 files hold a float32 `data` array of genes x samples, with the row and column
+    names in the `genes` and `samples` arrays.
+
+    Args:
+        path (str): Output file
+        format (str): 'parquet', 'feather' or 'hdf5'
+        samples (list[str]): Sample accessions, one column each
+        rows (Iterator[list]): Rows from matrix_rows
+    """
+    if format == 'hdf5':
+        import numpy as np
+        import tables
+
+        # a dense float32 array, not a pandas table -- tables keep per-column metadata
+        # in node attributes, which overflow past a few thousand sample columns
+        filters = tables.Filters(complevel=9, complib='blosc')
+        with tables.open_file(path, mode='w') as h5:
+            h5.create_array('/', 'samples', np.array([s.encode('utf-8') for s in samples], dtype=bytes))
+            genes_array = h5.create_vlarray('/', 'genes', tables.VLUnicodeAtom(), filters=filters)
+            if len(samples) == 0:
+                # no matching samples means no rows -- an extendable array needs at least one column
+                h5.create_array('/', 'data', np.empty((0, 0), dtype='float32'))
+                return
+
+            data = h5.create_earray('/', 'data', tables.Float32Atom(dflt=np.nan), shape=(0, len(samples)),
+                                    filters=filters, chunkshape=(HDF5_CHUNK_ROWS, min(len(samples), HDF5_CHUNK_COLUMNS)))
+            data.attrs.description = "gene x sample expression values, rows in the order of genes, columns in the order of samples"
+
+            for genes, values in gene_blocks(rows, len(samples)):
+                for gene in genes:
+                    genes_array.append(gene)
+                data.append(values)
+        return
+
+    import pyarrow as pa
+
+    schema = pa.schema([('gene', pa.string())] + [(s, pa.float32()) for s in samples])
+
+    if format == 'parquet':
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(path, schema, compression='zstd')
+    else:
+        import pyarrow.ipc as ipc
+        writer = ipc.new_file(path, schema, options=ipc.IpcWriteOptions(compression='zstd'))
+
+    with writer:
+        for genes, values in gene_blocks(rows, len(samples)):
+            # NaN marks a missing value, written as null
+            arrays = [pa.array(genes, pa.string())] + [pa.array(values[:, i], pa.float32(), from_pandas=True)
+                                                       for i in range(len(samples))]
+            if format == 'parquet':
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            else:
+                writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+
+
+def write_metadata(path: str, format: str, variables: List[str], rows: Iterator[list]):
+    """Write sample metadata as string columns
+
+    Metadata has one row per sample, so it is small enough to write in one piece.
+
+    Args:
+        path (str): Output file
+        format (str): 'parquet', 'feather' or 'hdf5'
+        variables (list[str]): Variable names
+        rows (Iterator[list]): Rows from metadata_rows
+    """
+    import pandas as pd
+
+    frame = pd.DataFrame(list(rows), columns=['sample_accession'] + variables, dtype='string')
+
+    if format == 'hdf5':
+        frame.astype(object).to_hdf(path, key='metadata', mode='w', complevel=9, complib='blosc')
+    elif format == 'parquet':
+        frame.to_parquet(path, index=False, compression='zstd')
+    else:
+        frame.to_feather(path, compression='zstd')
+
+
+def file_blocks(write, *args, chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+    """Write a file to a temporary location, then read it back a block at a time
+
+    Binary formats cannot be produced as a stream of rows, so they are spooled to disk.
+    """
+    fd, path = tempfile.mkstemp(prefix='respire_download_')
+    os.close(fd)
+    try:
+        write(path, *args)
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                yield data
+    finally:
+        os.remove(path)
+
+
+def metadata_binary_blocks(db: Session, query: schemas.DataQuery, format: str) -> Iterator[bytes]:
+    yield from file_blocks(write_metadata, format, *metadata_rows(db, query))
+
+
+def data_binary_blocks(db: Session, query: schemas.DataQuery, format: str) -> Iterator[bytes]:
+    yield from file_blocks(write_matrix, format, *matrix_rows(db, query))
+
+
+def readme_text(query: schemas.DataQuery, archive_time: datetime) -> str:
+    lines = [f"Downloaded on {archive_time.strftime('%m-%d-%Y at %H:%M:%S')}",
+             "Metadata sourced from NCBI databases including BioProject and the Gene Expression Omnibus",
+             "Includes data from the following studies:", "  " + "\n  ".join(query.study_accessions)]
+
+    if query.genes:
+        lines.append(f"Restricted to {len(query.genes)} genes")
+    if query.samples:
+        lines.append(f"Restricted to {len(query.samples)} samples")
+    for f in query.sample_filters or []:
+        lines.append(f"Samples where {f.variable} {f.op} {f.value}")
+
+    return "".join(line + "\n" for line in lines)
+
+
+def iter_zip(entries: Iterable[Tuple[str, Iterable]]) -> Iterator[bytes]:
+    """Build a ZIP archive on the fly
+
+    Args:
+        entries (Iterable[tuple[str, Iterable]]): Archive names and the text or byte blocks of each entry
+
+    Yields:
+        bytes: The archive, as it is written
+    """
+    stream = ZipStream()
+
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as zip:
+        for arcname, blocks in entries:
+            # entry sizes are unknown up front, so allow them to exceed 2 GB
+            with zip.open(arcname, 'w', force_zip64=True) as entry:
+                for block in blocks:
+                    entry.write(block if isinstance(block, bytes) else block.encode('utf-8'))
+                    data = stream.drain()
+                    if len(data) > 0:
+                        yield data
+
+    yield stream.drain()
+
+
+def iter_download_archive(query: schemas.DataQuery, format: str = 'csv', bind: Optional[Engine] = None) -> Iterator[bytes]:
+    """Stream the download archive for a set of studies
+
+    Opens its own session, since the response body is produced after the request's
+    session has been handed back. Pass the engine the archive key was computed on,
+    so a read replica never serves data older than the key.
+
+    Args:
+        query (schemas.DataQuery): Selected studies and filters
+        format (str, optional): One of DOWNLOAD_FORMATS. Defaults to 'csv'.
+        bind (Engine, optional): Engine to read from. Defaults to the API engine.
+
+    Yields:
+        bytes: A ZIP archive with metadata, data_compendium and readme.txt
+    """
+    check_format(format)
+
+    archive_time = datetime.now()
+    folder = f"respire_data_download_{archive_time.strftime('%Y%m%d_%H_%M_%S')}"
+    ext = DOWNLOAD_FORMATS[format]
+
+    db = SessionLocal(bind=bind) if bind is not None else SessionLocal()
+    try:
+        if format == 'csv':
+            metadata, data = metadata_csv_blocks(db, query), data_csv_blocks(db, query)
+        else:
+            metadata = metadata_binary_blocks(db, query, format)
+            data = data_binary_blocks(db, query, format)
+
+        yield from iter_zip([
+            (f"{folder}/metadata.{ext}", metadata),
+            (f"{folder}/data_compendium.{ext}", data),
+            (f"{folder}/readme.txt", [readme_text(query, archive_time)])
+        ])
+    finally:
+        db.close()
+
+
+#########################
+# archive cache
+#########################
+
+
+def archive_key(db: Session, query: schemas.DataQuery, format: str = 'csv') -> str:
+    """Content address of the archive for a set of studies
+
+    The key covers the sorted accessions and filters and the data version of each
+    study, so an ingest that touches any included study produces a new key.
+
+    Args:
+        db (Session): A database session
+        query (schemas.DataQuery): Selected studies and filters
+        format (str, optional): Download format. Defaults to 'csv'.
+
+    Returns:
+        str: A hex digest
+    """
+    accessions = sorted(set(query.study_accessions))
+    versions = crud.study_data_versions(db, accessions)
+
+    filters = {
+        'genes': sorted(set(query.genes)) if query.genes else None,
+        'samples': sorted(set(query.samples)) if query.samples else None,
+        'sample_filters': [f.dict() for f in query.sample_filters] if query.sample_filters else None
+    }
+
+    stamp = [f"archive={ARCHIVE_FORMAT}", f"format={format}", f"storage={GENE_EXPRESSION_STORAGE}"]
+    stamp.append(f"filters={json.dumps(filters, sort_keys=True)}")
+    stamp += [f"{a}={versions.get(a, 0)}" for a in accessions]
+
+    return hashlib.sha256("\n".join(stamp).encode('utf-8')).hexdigest()
+
+
+class ArchiveCache:
+    """Finished archives on local disk, capped in size with least-recently-used eviction"""
+
+    def __init__(self, directory: str = ARCHIVE_CACHE_DIR, max_bytes: int = ARCHIVE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.zip")
+
+    def get(self, key: str) -> Optional[str]:
+        """Path of a cached archive, marking it as recently used
+
+        Args:
+            key (str): Key from archive_key
+
+        Returns:
+            str: The archive path, or None on a miss
+        """
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def store(self, key: str, chunks: Iterable[bytes], pin: bool = False) -> Iterator[bytes]:
+        """Pass an archive through while writing it to the cache
+
+        The archive is only added once it has been produced in full, so a client that
+        disconnects part way does not leave a truncated entry.
+
+        Args:
+            key (str): Key from archive_key
+            chunks (Iterable[bytes]): The archive being streamed
+            pin (bool, optional): Keep it out of eviction, see pin. Defaults to False.
+
+        Yields:
+            bytes: The same chunks
+        """
+        partial = os.path.join(self.directory, f".{key}.{uuid.uuid4().hex}.partial")
+        complete = False
+        if pin:
+            self.pin(key)
+        try:
+            with open(partial, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            os.replace(partial, self.path(key))
+            complete = True
+        finally:
+            if not complete and os.path.exists(partial):
+                os.remove(partial)
+            if not complete and pin:
+                self.unpin(key)
+
+        self.evict()
+
+    def pin_path(self, key: str) -> str:
+        return os.path.join(self.directory, f".{key}.pin")
+
+    def pin(self, key: str):
+        """Keep an archive out of eviction until unpin, or for ARCHIVE_PIN_SECONDS"""
+        with open(self.pin_path(key), 'w'):
+            pass
+
+    def unpin(self, key: str):
+        try:
+            os.remove(self.pin_path(key))
+        except FileNotFoundError:
+            pass
+
+    def is_pinned(self, key: str) -> bool:
+        try:
+            return os.path.getmtime(self.pin_path(key)) > time.time() - ARCHIVE_PIN_SECONDS
+        except FileNotFoundError:
+            return False
+
+    def evict(self):
+        """Remove the least recently used archives until the cache fits in max_bytes
+
+        Pinned archives count towards the size but are never removed.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.zip'):
+                stat = entry.stat()
+                pinned = self.is_pinned(entry.name[:-len('.zip')])
+                entries.append((stat.st_mtime, stat.st_size, entry.path, pinned))
+            elif entry.name.endswith('.pin') and entry.stat().st_mtime <= time.time() - ARCHIVE_PIN_SECONDS:
+                # an archive that was never fetched
+                os.remove(entry.path)
+
+        total = sum(e[1] for e in entries)
+        for _, size, path, pinned in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if pinned:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,65 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional, Tuple
+from . import cache, crud, schemas
+
+# async versions of the read-only study lookups
+# statements are built by the same functions as the sync lookups in crud.py
+
+
+@cache.versioned(cache.STUDIES)
+async def list_organisms(db: AsyncSession, has_data: int = 1):
+    '''
+    Get a list of the available organisms in the database
+    '''
+    res = (await db.execute(crud.organisms_statement(has_data))).all()
+
+    return [str(i[0]) for i in res]
+
+
+@cache.versioned(cache.STUDIES)
+async def list_profiling_methods(db: AsyncSession, has_data: int = 1):
+    '''
+    Get a list of the available profiling methods in the database
+    '''
+    res = (await db.execute(crud.profiling_methods_statement(has_data))).all()
+
+    return [str(i[0]) for i in res]
+
+
+@cache.versioned(cache.STUDIES)
+async def count_facets(db: AsyncSession, search: schemas.Search):
+    '''
+    Count matching studies and their samples per organism, profiling method and has_data value in one query
+    '''
+    return crud.facets_results(await db.execute(crud.facets_statement(db, search)))
+
+
+async def search_studies_page(db: AsyncSession,
+                              search: schemas.Search,
+                              fields: Optional[List[str]] = None,
+                              limit: Optional[int] = None,
+                              cursor: Optional[Tuple[Optional[float], int]] = None,
+                              include_total: bool = False):
+    '''
+    Get one page of search results, continuing after cursor -- see crud.search_studies_page
+    '''
+    fields = fields or list(schemas.StudyBase.__fields__)
+    stmt, count_stmt = crud.page_statements(db, search, fields, limit, cursor, include_total)
+
+    total = (await db.execute(count_stmt)).scalar() if count_stmt is not None else None
+    rows = (await db.execute(stmt)).all()
+
+    return crud.page_results(rows, fields, limit, total)
+
+
+async def search_studies_batch(db: AsyncSession,
+                               searches: List[schemas.Search],
+                               fields: Optional[List[str]] = None,
+                               limit: Optional[int] = None):
+    '''
+    Run several searches in one scan of studies -- see crud.search_studies_batch
+    '''
+    fields = fields or list(schemas.StudyBase.__fields__)
+    rows = await db.execute(crud.batch_statement(db, searches, fields))
+
+    return crud.batch_results(rows, len(searches), fields, limit)
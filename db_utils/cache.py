@@ -0,0 +1,175 @@
+import functools
+import inspect
+import os
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, Optional
+
+from sqlalchemy import select
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from . import models
+
+# seconds a process trusts its last read of a data version before checking the database again
+DATA_VERSION_TTL = float(os.environ.get('DATA_VERSION_TTL') or 1.0)
+
+# most results kept per cached function
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES') or 1024)
+
+# data version scopes -- ingestion bumps the scope of whatever it changed
+STUDIES = 'studies'
+SAMPLES = 'samples'
+
+# last data version read per (database url, scope) -- replicas may be at different versions
+_versions = {}
+_versions_lock = threading.Lock()
+
+
+def bump_data_version(conn: Connection, scope: str = STUDIES):
+    """Invalidate everything cached under scope, in every process
+
+    Call inside the transaction that changes the data, so readers never see
+    the new version before the new data.
+
+    Args:
+        conn (Connection): Database connection
+        scope (str, optional): Data version scope. Defaults to STUDIES.
+    """
+    versions = models.DataVersion.__table__
+
+    res = conn.execute(
+        versions.update().where(
+            versions.c.scope == scope
+        ).values(version=versions.c.version + 1, updated=datetime.utcnow())
+    )
+    if res.rowcount == 0:
+        conn.execute(versions.insert().values(scope=scope, version=1, updated=datetime.utcnow()))
+
+
+def data_version(db: Session, scope: str = STUDIES) -> int:
+    """Current data version of scope, read from the database at most once per DATA_VERSION_TTL
+
+    Args:
+        db (Session): A database session
+        scope (str, optional): Data version scope. Defaults to STUDIES.
+
+    Returns:
+        int: The data version, 0 if the scope was never bumped
+    """
+    now = time.monotonic()
+    key = (str(db.bind.url), scope)
+
+    with _versions_lock:
+        checked = _versions.get(key)
+    if checked is not None and now - checked[0] < DATA_VERSION_TTL:
+        return checked[1]
+
+    version = db.execute(
+        select(models.DataVersion.version).where(models.DataVersion.scope == scope)
+    ).scalar() or 0
+
+    with _versions_lock:
+        _versions[key] = (now, version)
+
+    return version
+
+
+async def async_data_version(db: AsyncSession, scope: str = STUDIES) -> int:
+    """data_version for an async session -- shares the in-process cache of versions
+
+    Args:
+        db (AsyncSession): An async database session
+        scope (str, optional): Data version scope. Defaults to STUDIES.
+
+    Returns:
+        int: The data version, 0 if the scope was never bumped
+    """
+    now = time.monotonic()
+    key = (str(db.bind.url), scope)
+
+    with _versions_lock:
+        checked = _versions.get(key)
+    if checked is not None and now - checked[0] < DATA_VERSION_TTL:
+        return checked[1]
+
+    version = (await db.execute(
+        select(models.DataVersion.version).where(models.DataVersion.scope == scope)
+    )).scalar() or 0
+
+    with _versions_lock:
+        _versions[key] = (now, version)
+
+    return version
+
+
+def versioned(scope: str = STUDIES, max_entries: Optional[int] = None) -> Callable:
+    """Cache a crud function's results until the data version of scope changes
+
+    The decorated function must take a db session argument named db. Results are
+    keyed by the other arguments, which must have a stable repr. Coroutine functions
+    taking an async session are supported.
+
+    Args:
+        scope (str, optional): Data version scope the results depend on. Defaults to STUDIES.
+        max_entries (int, optional): Most results kept, least recently used dropped first. Defaults to CACHE_MAX_ENTRIES.
+
+    Returns:
+        Callable: The decorator
+    """
+    max_entries = max_entries or CACHE_MAX_ENTRIES
+
+    def decorator(function):
+        signature = inspect.signature(function)
+        results = OrderedDict()
+        lock = threading.Lock()
+
+        def lookup(args, kwargs):
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            db = arguments.arguments.pop('db')
+            return db, repr(sorted(arguments.arguments.items()))
+
+        def get(key, version):
+            with lock:
+                hit = results.get(key)
+                if hit is not None and hit[0] == version:
+                    results.move_to_end(key)
+                    return hit
+            return None
+
+        def put(key, version, value):
+            with lock:
+                results[key] = (version, value)
+                results.move_to_end(key)
+                while len(results) > max_entries:
+                    results.popitem(last=False)
+            return value
+
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                db, key = lookup(args, kwargs)
+                version = await async_data_version(db, scope)
+                hit = get(key, version)
+                if hit is not None:
+                    return hit[1]
+                return put(key, version, await function(*args, **kwargs))
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                db, key = lookup(args, kwargs)
+                version = data_version(db, scope)
+                hit = get(key, version)
+                if hit is not None:
+                    return hit[1]
+                return put(key, version, function(*args, **kwargs))
+
+        wrapper.cache_clear = results.clear
+        return wrapper
+
+    return decorator
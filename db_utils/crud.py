@@ -1,26 +1,381 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import select
-from typing import List
-from . import models, schemas
+from sqlalchemy import and_, bindparam, case, func, literal, literal_column, or_, select, text, true, union_all, table as sql_table, column as sql_column
+from typing import List, Optional, Tuple, Union
+from . import cache, models, schemas
+from .database import GENE_EXPRESSION_STORAGE
 
 # return results from front end search
 
 
 def search_studies(db: Session,
-                   search_string: str,
-                   n_samples: int,
-                   organism: str,
-                   profiling_method: str,
-                   has_data: int):
-    return db.query(
+                   search_string: str = "",
+                   n_samples: Optional[int] = None,
+                   organism: Optional[Union[str, List[str]]] = None,
+                   profiling_method: Optional[Union[str, List[str]]] = None,
+                   has_data: Optional[int] = None,
+                   n_samples_max: Optional[int] = None):
+    query = db.query(
         models.Study
     ).filter(
-        models.Study.description.ilike(f"%{search_string}%"),
-        models.Study.n_samples >= n_samples,
-        models.Study.organism_name == organism,
-        models.Study.gds_type == profiling_method,
-        models.Study.has_data == has_data
-    ).all()
+        *study_conditions(n_samples=n_samples,
+                          n_samples_max=n_samples_max,
+                          organism=organism,
+                          profiling_method=profiling_method,
+                          has_data=has_data)
+    )
+
+    query, rank = study_text_search(db, query, search_string)
+
+    return order_studies(query, rank).all()
+
+
+def study_conditions(n_samples: Optional[int] = None,
+                     n_samples_max: Optional[int] = None,
+                     organism: Optional[Union[str, List[str]]] = None,
+                     profiling_method: Optional[Union[str, List[str]]] = None,
+                     has_data: Optional[int] = None):
+    '''
+    Build conditions for the study filters that were supplied, so the indexes on studies stay usable
+    '''
+    conditions = []
+
+    if has_data is not None:
+        conditions.append(models.Study.has_data == has_data)
+    if organism:
+        conditions.append(value_condition(models.Study.organism_name, organism))
+    if profiling_method:
+        conditions.append(value_condition(models.Study.gds_type, profiling_method))
+    if n_samples is not None:
+        conditions.append(models.Study.n_samples >= n_samples)
+    if n_samples_max is not None:
+        conditions.append(models.Study.n_samples <= n_samples_max)
+
+    return conditions
+
+
+def search_conditions(search: schemas.Search):
+    '''
+    Build the study filter conditions of a search object
+    '''
+    return study_conditions(n_samples=search.n_samples,
+                            n_samples_max=search.n_samples_max,
+                            organism=search.organism,
+                            profiling_method=search.profiling_method,
+                            has_data=search.has_data)
+
+
+def value_condition(column, value: Union[str, List[str]]):
+    '''
+    Match a column to one value or to any of a list of values
+    '''
+    if isinstance(value, list):
+        return column.in_(value)
+    return column == value
+
+
+def study_text_search(db: Session, query, search_string: str):
+    '''
+    Restrict a study query to full-text matches of search_string
+
+    Returns the query and a relevance expression that sorts the best matches first,
+    or None when there is nothing to rank
+    '''
+    terms = search_string.split()
+    if not terms:
+        return query, None
+
+    dialect = db.bind.dialect.name
+
+    if dialect == 'postgresql':
+        # same expression as the GIN index, so the planner can use it
+        document = literal_column(models.STUDY_SEARCH_DOCUMENT)
+        tsquery = func.websearch_to_tsquery(literal_column(models.STUDY_SEARCH_CONFIG), search_string)
+        return query.filter(document.op('@@')(tsquery)), -func.ts_rank(document, tsquery)
+
+    if dialect == 'sqlite':
+        matches = fts_matches(terms).subquery()
+        return query.join(matches, matches.c.rowid == models.Study.study_id), matches.c.rank
+
+    # no text index for other databases -- every term must appear in one of the columns
+    for term in terms:
+        query = query.filter(or_(
+            models.Study.title.ilike(f"%{term}%"),
+            models.Study.description.ilike(f"%{term}%"),
+            models.Study.organization.ilike(f"%{term}%")
+        ))
+    return query, None
+
+
+def fts_matches(terms: List[str]):
+    '''
+    Select the rowid and bm25 rank of the sqlite FTS5 matches of every term
+    '''
+    # quote each term so fts5 operators in user input are matched literally
+    fts_query = ' '.join('"{}"'.format(t.replace('"', '""')) for t in terms)
+    fts = sql_table('studies_fts', sql_column('rowid'), sql_column('rank'))
+    return select(
+        fts.c.rowid, fts.c.rank
+    ).where(
+        text("studies_fts match :fts_query").bindparams(bindparam('fts_query', fts_query, unique=True))
+    )
+
+
+def study_text_condition(db: Session, search_string: str):
+    '''
+    Build a condition for full-text matches of search_string, for statements that cannot join on the matches
+
+    Returns the condition and a relevance expression that sorts the best matches first,
+    either None when there is nothing to match or rank
+    '''
+    terms = search_string.split()
+    if not terms:
+        return None, None
+
+    dialect = db.bind.dialect.name
+
+    if dialect == 'postgresql':
+        document = literal_column(models.STUDY_SEARCH_DOCUMENT)
+        tsquery = func.websearch_to_tsquery(literal_column(models.STUDY_SEARCH_CONFIG), search_string)
+        return document.op('@@')(tsquery), -func.ts_rank(document, tsquery)
+
+    if dialect == 'sqlite':
+        matches = fts_matches(terms)
+        fts = matches.selected_columns
+        rank = matches.with_only_columns(fts.rank).where(fts.rowid == models.Study.study_id).scalar_subquery()
+        return models.Study.study_id.in_(matches.with_only_columns(fts.rowid)), rank
+
+    return and_(*[or_(
+        models.Study.title.ilike(f"%{term}%"),
+        models.Study.description.ilike(f"%{term}%"),
+        models.Study.organization.ilike(f"%{term}%")
+    ) for term in terms]), None
+
+
+def order_studies(query, rank=None):
+    '''
+    Order a study query by relevance, then study_id
+    '''
+    if rank is None:
+        return query.order_by(models.Study.study_id)
+    return query.order_by(rank, models.Study.study_id)
+
+
+# facet name -> study column counted by count_facets
+STUDY_FACETS = {
+    'organism': models.Study.organism_name,
+    'profiling_method': models.Study.gds_type,
+    'has_data': models.Study.has_data,
+}
+
+
+def facets_statement(db: Session, search: schemas.Search):
+    '''
+    Build the statement counting studies and samples per facet value
+
+    Postgres groups once with GROUPING SETS; other databases union one group by per facet
+    '''
+    stmt = select(*STUDY_FACETS.values(), models.Study.n_samples).where(*search_conditions(search))
+    stmt, _ = study_text_search(db, stmt, search.search_string)
+    matches = stmt.subquery()
+
+    columns = [matches.c[column.key] for column in STUDY_FACETS.values()]
+    n_studies = func.count().label('n_studies')
+    n_samples = func.coalesce(func.sum(matches.c.n_samples), 0).label('n_samples')
+
+    if db.bind.dialect.name == 'postgresql':
+        return select(
+            *[func.grouping(c) for c in columns], *columns, n_studies, n_samples
+        ).group_by(
+            func.grouping_sets(*columns)
+        )
+
+    return union_all(*[
+        select(
+            literal(name).label('facet'), column.label('value'), n_studies, n_samples
+        ).group_by(column)
+        for name, column in zip(STUDY_FACETS, columns)
+    ])
+
+
+def facets_results(rows):
+    '''
+    Collect the rows of facets_statement into counts per facet, largest first
+    '''
+    facets = {name: [] for name in STUDY_FACETS}
+    n_facets = len(STUDY_FACETS)
+
+    for row in rows:
+        if 'facet' in row._fields:
+            facet, value = row.facet, row.value
+        else:
+            # grouping sets -- exactly one column is grouped in each set, and grouping() is 0 for it
+            i = list(row[:n_facets]).index(0)
+            facet, value = list(STUDY_FACETS)[i], row[n_facets + i]
+        facets[facet].append({'value': value, 'n_studies': row.n_studies, 'n_samples': row.n_samples})
+
+    for counts in facets.values():
+        counts.sort(key=lambda c: (-c['n_studies'], str(c['value'])))
+
+    return facets
+
+
+@cache.versioned(cache.STUDIES)
+def count_facets(db: Session, search: schemas.Search):
+    '''
+    Count matching studies and their samples per organism, profiling method and has_data value in one query
+    '''
+    return facets_results(db.execute(facets_statement(db, search)))
+
+
+def batch_statement(db: Session, searches: List[schemas.Search], fields: List[str]):
+    '''
+    Build one statement running several searches
+
+    Predicates shared by every search are applied once; the rest are tagged per search
+    with CASE expressions, so each row can be routed to the searches it matches.
+    '''
+    columns = [models.Study.study_id] + [getattr(models.Study, f) for f in fields if f != 'study_id']
+
+    per_search = []
+    for search in searches:
+        conditions = search_conditions(search)
+        match, rank = study_text_condition(db, search.search_string)
+        if match is not None:
+            conditions.append(match)
+        per_search.append((conditions, rank))
+
+    shared = [c for c in per_search[0][0]
+              if all(any(c.compare(o) for o in conditions) for conditions, _ in per_search[1:])]
+
+    tags, any_match = [], []
+    for i, (conditions, rank) in enumerate(per_search):
+        own = [c for c in conditions if not any(c.compare(s) for s in shared)]
+        match = and_(*own) if own else true()
+        any_match.append(match)
+        tags.append(case((match, 1), else_=0).label(f"match_{i}"))
+        tags.append(case((match, rank), else_=None).label(f"rank_{i}") if rank is not None
+                    else literal(None).label(f"rank_{i}"))
+
+    stmt = select(*columns, *tags).where(*shared)
+    if all(len(conditions) > len(shared) for conditions, _ in per_search):
+        stmt = stmt.where(or_(*any_match))
+
+    return stmt
+
+
+def batch_results(rows, n_searches: int, fields: List[str], limit: Optional[int] = None):
+    '''
+    Route the rows of batch_statement to their searches, most relevant first
+    '''
+    results = {i: [] for i in range(n_searches)}
+    for row in rows:
+        row = row._mapping
+        study = {f: row[f] for f in ['study_id'] + fields}
+        for i in results:
+            if row[f"match_{i}"]:
+                results[i].append((row[f"rank_{i}"], study))
+
+    for i, matches in results.items():
+        matches.sort(key=lambda m: (m[0] if m[0] is not None else 0, m[1]['study_id']))
+        results[i] = [study for _, study in matches[:limit]]
+
+    return results
+
+
+def search_studies_batch(db: Session,
+                         searches: List[schemas.Search],
+                         fields: Optional[List[str]] = None,
+                         limit: Optional[int] = None):
+    '''
+    Run several searches in one scan of studies
+
+    Returns a dict of search index -> result rows, most relevant first
+    '''
+    fields = fields or list(schemas.StudyBase.__fields__)
+    rows = db.execute(batch_statement(db, searches, fields))
+
+    return batch_results(rows, len(searches), fields, limit)
+
+
+def page_statements(db: Session,
+                    search: schemas.Search,
+                    fields: List[str],
+                    limit: Optional[int] = None,
+                    cursor: Optional[Tuple[Optional[float], int]] = None,
+                    include_total: bool = False):
+    '''
+    Build the statement selecting one page of search results, and the statement counting all matches
+
+    Only the requested fields and study_id are selected. Pages are read with a keyset on
+    (relevance, study_id), so deep pages cost the same as the first one. The count
+    statement is None unless include_total.
+    '''
+    columns = [models.Study.study_id] + [getattr(models.Study, f) for f in fields if f != 'study_id']
+
+    stmt = select(*columns).where(*search_conditions(search))
+    stmt, rank = study_text_search(db, stmt, search.search_string)
+
+    count_stmt = None
+    if include_total:
+        count_stmt = select(func.count()).select_from(stmt.subquery())
+
+    if cursor is not None:
+        last_rank, last_study_id = cursor
+        if rank is None or last_rank is None:
+            stmt = stmt.where(models.Study.study_id > last_study_id)
+        else:
+            stmt = stmt.where(or_(
+                rank > last_rank,
+                and_(rank == last_rank, models.Study.study_id > last_study_id)
+            ))
+
+    if rank is not None:
+        stmt = stmt.add_columns(rank.label('search_rank'))
+
+    stmt = order_studies(stmt, rank)
+    if limit:
+        stmt = stmt.limit(limit + 1)
+
+    return stmt, count_stmt
+
+
+def page_results(rows: list, fields: List[str], limit: Optional[int] = None, total: Optional[int] = None):
+    '''
+    Collect the rows of a page statement into results and the cursor of the next page
+    '''
+    next_cursor = None
+    if limit and len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]._mapping
+        next_cursor = (last.get('search_rank'), last['study_id'])
+
+    results = []
+    for row in rows:
+        row = row._mapping
+        results.append({f: row[f] for f in ['study_id'] + fields if f in row})
+
+    return {'results': results, 'next_cursor': next_cursor, 'total': total}
+
+
+def search_studies_page(db: Session,
+                        search: schemas.Search,
+                        fields: Optional[List[str]] = None,
+                        limit: Optional[int] = None,
+                        cursor: Optional[Tuple[Optional[float], int]] = None,
+                        include_total: bool = False):
+    '''
+    Get one page of search results, continuing after cursor
+
+    Returns a dict with the result rows, the cursor of the next page (None on the last page)
+    and the total number of matches if include_total
+    '''
+    fields = fields or list(schemas.StudyBase.__fields__)
+    stmt, count_stmt = page_statements(db, search, fields, limit, cursor, include_total)
+
+    total = db.execute(count_stmt).scalar() if count_stmt is not None else None
+    rows = db.execute(stmt).all()
+
+    return page_results(rows, fields, limit, total)
 
 
 def add_studies(db: Session, studies: List[schemas.StudyCreate]):
@@ -30,15 +385,16 @@ def add_studies(db: Session, studies: List[schemas.StudyCreate]):
     for study in studies:
         s = models.Study(**study.dict())
         db.add(s)
+    cache.bump_data_version(db.connection(), cache.STUDIES)
     db.commit()
     return [s.study_id for s in studies]
 
 
-def list_organisms(db: Session, has_data: int = 1):
+def organisms_statement(has_data: int = 1):
     '''
-    Get a list of the available organisms in the database
+    Build the statement listing the organisms of studies, shared by the sync and async lookups
     '''
-    stmt = select(
+    return select(
         models.Study.organism_name.distinct()
     ).filter(
         models.Study.has_data == has_data
@@ -46,16 +402,12 @@ def list_organisms(db: Session, has_data: int = 1):
         models.Study.organism_name
     )
 
-    res = db.execute(stmt).all()
-
-    return [str(i[0]) for i in res]
 
-
-def list_profiling_methods(db: Session, has_data: int = 1):
+def profiling_methods_statement(has_data: int = 1):
     '''
-    Get a list of the available organisms in the database
+    Build the statement listing the profiling methods of studies, shared by the sync and async lookups
     '''
-    stmt = select(
+    return select(
         models.Study.gds_type.distinct()
     ).filter(
         models.Study.has_data == has_data
@@ -63,11 +415,28 @@ def list_profiling_methods(db: Session, has_data: int = 1):
         models.Study.gds_type
     )
 
-    res = db.execute(stmt).all()
+
+@cache.versioned(cache.STUDIES)
+def list_organisms(db: Session, has_data: int = 1):
+    '''
+    Get a list of the available organisms in the database
+    '''
+    res = db.execute(organisms_statement(has_data)).all()
+
+    return [str(i[0]) for i in res]
+
+
+@cache.versioned(cache.STUDIES)
+def list_profiling_methods(db: Session, has_data: int = 1):
+    '''
+    Get a list of the available organisms in the database
+    '''
+    res = db.execute(profiling_methods_statement(has_data)).all()
 
     return [str(i[0]) for i in res]
 
 
+@cache.versioned(cache.STUDIES)
 def get_study_accessions(db: Session):
     '''
     Get a list of all study accessions
@@ -81,3 +450,202 @@ def get_study_accessions(db: Session):
     return [str(i[0]) for i in res]
 
 
+def sample_filter_condition(sample_filter: schemas.SampleFilter):
+    '''
+    Build the condition on samples.value for one metadata predicate
+    '''
+    value = sample_filter.value
+    values = value if isinstance(value, list) else [value]
+
+    # equality is matched on the indexed key of the value too, then on the value itself
+    value_key = models.sample_value_key(models.Sample.value)
+
+    if sample_filter.op == 'in':
+        return and_(value_key.in_([models.sample_value_key(literal(v)) for v in values]),
+                    models.Sample.value.in_(values))
+    if sample_filter.op == 'ne':
+        return models.Sample.value != values[0]
+    if sample_filter.op == 'contains':
+        # match the text literally -- % and _ in it are not wildcards
+        pattern = str(values[0]).replace('/', '//').replace('%', '/%').replace('_', '/_')
+        return models.Sample.value.ilike(f"%{pattern}%", escape='/')
+    return and_(value_key == models.sample_value_key(literal(values[0])),
+                models.Sample.value == values[0])
+
+
+def sample_conditions(column,
+                      study_accessions: List[str],
+                      samples: Optional[List[str]] = None,
+                      sample_filters: Optional[List[schemas.SampleFilter]] = None):
+    '''
+    Build conditions restricting a sample_accession column to a sample list and metadata predicates
+    '''
+    conditions = []
+
+    if samples:
+        conditions.append(column.in_(samples))
+
+    # each predicate is a keyed lookup on (accession_number, variable, value key)
+    for sample_filter in sample_filters or []:
+        conditions.append(column.in_(
+            select(
+                models.Sample.sample_accession
+            ).where(
+                models.Sample.accession_number.in_(study_accessions),
+                models.Sample.variable == sample_filter.variable,
+                sample_filter_condition(sample_filter)
+            )
+        ))
+
+    return conditions
+
+
+def expression_query(db: Session,
+                     study_accessions: List[str],
+                     ordered: bool = False,
+                     genes: Optional[List[str]] = None,
+                     samples: Optional[List[str]] = None,
+                     sample_filters: Optional[List[schemas.SampleFilter]] = None):
+    '''
+    Query gene, sample_accession and value for the selected studies from the configured storage layout,
+    optionally restricted to a gene list, a sample list and sample metadata predicates
+    '''
+    if GENE_EXPRESSION_STORAGE == 'compact':
+        gene, sample_accession = models.ExpressionGene.gene, models.ExpressionSample.sample_accession
+        query = db.query(
+            gene,
+            sample_accession,
+            models.GeneExpressionCompact.value
+        ).join(
+            models.ExpressionStudy,
+            models.ExpressionStudy.study_key == models.GeneExpressionCompact.study_key
+        ).join(
+            models.ExpressionGene,
+            models.ExpressionGene.gene_key == models.GeneExpressionCompact.gene_key
+        ).join(
+            models.ExpressionSample,
+            models.ExpressionSample.sample_key == models.GeneExpressionCompact.sample_key
+        ).filter(
+            models.ExpressionStudy.accession_number.in_(study_accessions)
+        )
+    else:
+        gene, sample_accession = models.GeneExpression.gene, models.GeneExpression.sample_accession
+        query = db.query(
+            gene,
+            sample_accession,
+            models.GeneExpression.value
+        ).filter(
+            models.GeneExpression.accession_number.in_(study_accessions)
+        )
+
+    if genes:
+        query = query.filter(gene.in_(genes))
+
+    query = query.filter(
+        *sample_conditions(sample_accession, study_accessions, samples, sample_filters)
+    )
+
+    if ordered:
+        # archives.matrix_rows merges per-study cursors in python string order -- postgres
+        # sorts by the database collation unless told to compare bytes, which
+        # models.GENE_ORDER_INDEXES serve in index order
+        if db.bind.dialect.name == 'postgresql':
+            query = query.order_by(gene.collate('C'), sample_accession)
+        else:
+            query = query.order_by(gene, sample_accession)
+
+    return query
+
+
+def list_expression_samples(db: Session,
+                            study_accessions: List[str],
+                            samples: Optional[List[str]] = None,
+                            sample_filters: Optional[List[schemas.SampleFilter]] = None):
+    '''
+    Get a sorted list of the samples with expression data in the selected studies
+    '''
+    if GENE_EXPRESSION_STORAGE == 'compact':
+        stmt = select(
+            models.ExpressionSample.sample_accession
+        ).where(
+            models.ExpressionSample.sample_key.in_(
+                select(models.GeneExpressionCompact.sample_key).join(
+                    models.ExpressionStudy,
+                    models.ExpressionStudy.study_key == models.GeneExpressionCompact.study_key
+                ).where(
+                    models.ExpressionStudy.accession_number.in_(study_accessions)
+                )
+            ),
+            *sample_conditions(models.ExpressionSample.sample_accession, study_accessions, samples, sample_filters)
+        )
+    else:
+        stmt = select(
+            models.GeneExpression.sample_accession.distinct()
+        ).where(
+            models.GeneExpression.accession_number.in_(study_accessions),
+            *sample_conditions(models.GeneExpression.sample_accession, study_accessions, samples, sample_filters)
+        )
+
+    res = db.execute(stmt).all()
+
+    return sorted(str(i[0]) for i in res)
+
+
+def list_document_studies(db: Session, study_accessions: List[str]):
+    '''
+    Get a sorted list of the selected studies whose per-sample metadata documents have been built
+    '''
+    stmt = select(
+        models.SampleDocument.accession_number.distinct()
+    ).where(
+        models.SampleDocument.accession_number.in_(study_accessions)
+    )
+
+    res = db.execute(stmt).all()
+
+    return sorted(str(i[0]) for i in res)
+
+
+def list_sample_variables(db: Session, conditions: list):
+    '''
+    Get a sorted list of the metadata variables in the sample documents matching conditions
+    '''
+    if db.bind.dialect.name == 'postgresql':
+        keys = func.jsonb_object_keys(models.SampleDocument.document)
+        res = db.execute(select(keys.distinct()).where(*conditions)).all()
+        return sorted(str(i[0]) for i in res)
+
+    variables = set()
+    for (document,) in db.query(models.SampleDocument.document).filter(*conditions).yield_per(10000):
+        variables.update(document or {})
+
+    return sorted(variables)
+
+
+def has_sample_metadata(db: Session, study_accessions: List[str]):
+    '''
+    Check whether any of the selected studies have sample metadata
+    '''
+    stmt = select(
+        models.Sample.id
+    ).where(
+        models.Sample.accession_number.in_(study_accessions)
+    ).limit(1)
+
+    return db.execute(stmt).first() is not None
+
+
+def study_data_versions(db: Session, study_accessions: List[str]):
+    '''
+    Get the data version of each selected study, bumped every time an ingest touches it
+    '''
+    stmt = select(
+        models.StudyDataSummary.accession_number,
+        models.StudyDataSummary.version
+    ).where(
+        models.StudyDataSummary.accession_number.in_(study_accessions)
+    )
+
+    res = db.execute(stmt).all()
+
+    return {str(i[0]): int(i[1] or 0) for i in res}
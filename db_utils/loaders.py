@@ -0,0 +1,1099 @@
+import csv
+import hashlib
+import io
+import itertools
+import re
+import time
+import uuid
+
+from datetime import datetime
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import func, select, text, table as sql_table, column as sql_column
+from sqlalchemy.engine import Connection, Engine
+
+from . import cache, models
+from .database import GENE_EXPRESSION_STORAGE
+
+# read the source file in blocks of this many bytes -- this bounds worker memory
+DEFAULT_CHUNK_BYTES = 64 * 1024 * 1024
+
+# columns required in an expression file and the names they are stored under
+EXPRESSION_COLUMNS = ['accession_number', 'gene', 'sample_accession', 'value']
+
+# header names accepted in place of the stored column names
+EXPRESSION_COLUMN_ALIASES = {
+    'study_accession': 'accession_number'
+}
+
+# text values that postgres can cast to a number -- anything else, e.g. NA, is stored as NULL
+NUMERIC_PATTERN = r'^\s*[-+]?([0-9]+(\.[0-9]*)?|\.[0-9]+)([eE][-+]?[0-9]+)?\s*$'
+
+# largest float4 value
+REAL_MAX = 3.4028234663852886e38
+
+
+def iter_line_chunks(stream, chunk_bytes: int = DEFAULT_CHUNK_BYTES) -> Iterator[bytes]:
+    """Read a binary stream in blocks that always end on a line boundary
+
+    Args:
+        stream (file-like): An object with a read(n) method returning bytes, e.g. an S3 StreamingBody
+        chunk_bytes (int, optional): Approximate block size. Defaults to DEFAULT_CHUNK_BYTES.
+
+    Yields:
+        bytes: One or more complete lines
+    """
+    remainder = b''
+    while True:
+        block = stream.read(chunk_bytes)
+        if not block:
+            break
+
+        block = remainder + block
+        cut = block.rfind(b'\n') + 1
+
+        # a single line longer than chunk_bytes -- keep reading
+        if cut == 0:
+            remainder = block
+            continue
+
+        remainder = block[cut:]
+        yield block[:cut]
+
+    # last line of a file without a trailing newline
+    if remainder:
+        yield remainder + b'\n'
+
+
+def parse_expression_header(line: bytes) -> List[str]:
+    """Map the header of an expression file to gene_expression columns
+
+    Args:
+        line (bytes): The first line of the file
+
+    Raises:
+        ValueError: If a required column is missing
+
+    Returns:
+        list[str]: Column names in file order
+    """
+    names = next(csv.reader([line.decode('utf-8-sig').strip()]))
+    columns = [EXPRESSION_COLUMN_ALIASES.get(n.strip(), n.strip()) for n in names]
+
+    missing = [c for c in EXPRESSION_COLUMNS if c not in columns]
+    if len(missing) > 0:
+        raise ValueError(f"Expression file is missing columns: {', '.join(missing)}")
+
+    return columns
+
+
+def accession_pattern(columns: List[str]):
+    """Regex capturing the accession_number field of each CSV line
+
+    Accessions never contain commas, so a byte-level scan is enough and avoids
+    parsing every row in Python.
+    """
+    k = columns.index('accession_number')
+    # at least one character -- with re.M, ^ also matches after the block's final newline
+    return re.compile(rb'^(?:[^,\n]*,){%d}"?([^,"\r\n]+)' % k, re.M)
+
+
+def conflict_columns(table: str) -> List[str]:
+    """Primary key columns of a table, used as the conflict target for upserts"""
+    return [c.name for c in models.Base.metadata.tables[table].primary_key]
+
+
+def is_compact(table: str) -> bool:
+    """True if rows for this table are stored in the compact expression layout"""
+    return table == models.GeneExpression.__tablename__ and GENE_EXPRESSION_STORAGE == 'compact'
+
+
+def stage_table(conn: Connection, table: str) -> str:
+    """Create an empty, connection-local copy of a table to load a block into
+
+    Args:
+        conn (Connection): An open connection
+        table (str): Table to copy the columns of
+
+    Returns:
+        str: Name of the temporary table
+    """
+    stage = f"{table}_stage"
+    if conn.dialect.name == 'postgresql':
+        conn.exec_driver_sql(
+            f"CREATE TEMP TABLE IF NOT EXISTS {stage} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+        )
+    else:
+        conn.exec_driver_sql(f"CREATE TEMP TABLE IF NOT EXISTS {stage} AS SELECT * FROM {table} WHERE 1 = 0")
+        conn.exec_driver_sql(f"DELETE FROM {stage}")
+    return stage
+
+
+def copy_chunk(conn: Connection, table: str, columns: List[str], chunk: bytes, upsert: bool = False):
+    """Load CSV lines with PostgreSQL COPY ... FROM STDIN
+
+    With upsert, or when the table uses compact storage, lines are copied into a session-local
+    staging table and merged with INSERT ... ON CONFLICT, so rows that were already loaded are
+    overwritten instead of failing.
+
+    Args:
+        conn (Connection): An open connection on a postgres engine
+        table (str): Target table
+        columns (list[str]): Column names in file order
+        chunk (bytes): Complete CSV lines, without a header
+        upsert (bool, optional): Merge into existing rows. Defaults to False.
+    """
+    staged = upsert or is_compact(table)
+    target = stage_table(conn, table) if staged else table
+
+    cmd = f"COPY {target} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(cmd, io.BytesIO(chunk))
+    finally:
+        cursor.close()
+
+    if staged:
+        merge_into(conn, table, target, columns)
+
+
+def merge_into(conn: Connection, table: str, source: str, columns: List[str]):
+    """Upsert every row of a staging table into a table, or into the compact layout
+
+    Args:
+        conn (Connection): An open connection
+        table (str): Target table
+        source (str): Table holding the new rows
+        columns (list[str]): Columns to copy
+    """
+    if is_compact(table):
+        merge_compact(conn, source)
+    else:
+        merge_table(conn, table, source, columns)
+
+
+def merge_table(conn: Connection, table: str, source: str, columns: List[str]):
+    """Upsert every row of one table into another with INSERT ... SELECT ... ON CONFLICT
+
+    Args:
+        conn (Connection): An open connection
+        table (str): Target table
+        source (str): Table holding the new rows
+        columns (list[str]): Columns to copy
+    """
+    keys = conflict_columns(table)
+    cols = ', '.join(columns)
+
+    if conn.dialect.name == 'postgresql':
+        # a row may only be updated once per statement, so drop duplicate keys first
+        select_cmd = f"select distinct on ({', '.join(keys)}) {cols} from {source}"
+    else:
+        # sqlite needs a WHERE clause to parse ON CONFLICT after a SELECT
+        select_cmd = f"select {cols} from {source} where true"
+
+    conflict_cmd = ''
+    if conn.dialect.name in ('postgresql', 'sqlite'):
+        updates = [c for c in columns if c not in keys]
+        conflict_cmd = f"""
+        on conflict ({', '.join(keys)}) do update
+        set {', '.join(f'{c} = excluded.{c}' for c in updates)}"""
+
+    conn.exec_driver_sql(f"insert into {table} ({cols}) {select_cmd} {conflict_cmd}")
+
+
+def to_real(value) -> Optional[float]:
+    """A text expression value as a finite float4-range number, None if it is not one"""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if abs(number) <= REAL_MAX else None
+
+
+def real_value(conn: Connection, column: str) -> str:
+    """SQL casting a text column to real, with NULL for empty and non-numeric values such as NA
+
+    Postgres checks the text against NUMERIC_PATTERN, bound as :numeric_pattern. SQLite
+    would cast non-numeric text to 0.0, so it calls to_real, registered on the connection.
+
+    Args:
+        conn (Connection): An open connection
+        column (str): The text column
+
+    Returns:
+        str: A SQL expression
+    """
+    if conn.dialect.name == 'postgresql':
+        number = f"cast({column} as double precision)"
+        # nested, since only case guarantees the pattern is checked before the cast
+        return (f"case when {column} ~ :numeric_pattern then "
+                f"case when abs({number}) <= {REAL_MAX} then cast({number} as real) end end")
+
+    if conn.dialect.name == 'sqlite':
+        conn.connection.create_function('to_real', 1, to_real, deterministic=True)
+        return f"to_real({column})"
+
+    return f"cast(nullif({column}, '') as real)"
+
+
+def merge_compact(conn: Connection, source: str, where: str = 'true', params: Optional[dict] = None) -> int:
+    """Upsert rows shaped like gene_expression into the compact layout
+
+    New accessions, genes and samples are added to the dictionary tables first, then the
+    values are inserted as float4 under their integer keys. Empty and non-numeric values,
+    e.g. NA, are stored as NULL.
+
+    Args:
+        conn (Connection): An open connection
+        source (str): Table with accession_number, gene, sample_accession and value columns, aliased as src
+        where (str, optional): Filter on the source rows. Defaults to 'true'.
+        params (dict, optional): Bind parameters for where. Defaults to None.
+
+    Returns:
+        int: Number of rows written
+    """
+    upsert = conn.dialect.name in ('postgresql', 'sqlite')
+
+    dictionaries = [(models.ExpressionStudy.__tablename__, 'accession_number'),
+                    (models.ExpressionGene.__tablename__, 'gene'),
+                    (models.ExpressionSample.__tablename__, 'sample_accession')]
+
+    for dictionary, column in dictionaries:
+        if upsert:
+            new_only = f"on conflict ({column}) do nothing"
+        else:
+            new_only = f"and not exists (select 1 from {dictionary} d where d.{column} = src.{column})"
+
+        conn.execute(text(f"""
+        insert into {dictionary} ({column})
+        select distinct src.{column} from {source} src
+        where {where} {new_only}
+        """), params or {})
+
+    keys = 'st.study_key, g.gene_key, sa.sample_key'
+    distinct_cmd = f"distinct on ({keys})" if conn.dialect.name == 'postgresql' else ''
+    conflict_cmd = ''
+    if upsert:
+        conflict_cmd = "on conflict (study_key, gene_key, sample_key) do update set value = excluded.value"
+
+    res = conn.execute(text(f"""
+    insert into {models.GeneExpressionCompact.__tablename__} (study_key, gene_key, sample_key, value)
+    select {distinct_cmd} {keys}, {real_value(conn, 'src.value')}
+    from {source} src
+    join {models.ExpressionStudy.__tablename__} st on st.accession_number = src.accession_number
+    join {models.ExpressionGene.__tablename__} g on g.gene = src.gene
+    join {models.ExpressionSample.__tablename__} sa on sa.sample_accession = src.sample_accession
+    where {where}
+    {conflict_cmd}
+    """), {**(params or {}), 'numeric_pattern': NUMERIC_PATTERN})
+
+    return res.rowcount
+
+
+def migrate_expression_storage(engine: Engine, drop_source: bool = False, log: Optional[Callable[[str], None]] = print) -> dict:
+    """Copy existing gene_expression rows into the compact layout
+
+    Each study is copied in its own transaction, so the migration can be stopped and run
+    again. Set GENE_EXPRESSION_STORAGE=compact once it has finished.
+
+    Args:
+        engine (Engine): Database engine
+        drop_source (bool, optional): Delete each study from gene_expression once copied. Defaults to False.
+        log (Callable, optional): Progress callback. Defaults to print.
+
+    Returns:
+        dict: Number of studies and rows migrated
+    """
+    table = models.GeneExpression.__tablename__
+
+    with engine.connect() as conn:
+        accessions = [r[0] for r in conn.exec_driver_sql(f"select distinct accession_number from {table}")]
+
+    n_rows = 0
+    for i, accession in enumerate(accessions):
+        with engine.begin() as conn:
+            n_rows += merge_compact(conn, table,
+                                    where='src.accession_number = :accession_number',
+                                    params={'accession_number': accession})
+            if drop_source:
+                conn.execute(text(f"delete from {table} where accession_number = :accession_number"),
+                             {'accession_number': accession})
+
+        if log is not None:
+            log(f"Migrated {accession} ({i + 1}/{len(accessions)})")
+
+    return {'studies': len(accessions), 'rows': n_rows}
+
+
+def upsert_statement(conn: Connection, table: str, columns: List[str]):
+    """Build an INSERT ... ON CONFLICT DO UPDATE for the connection's dialect
+
+    Args:
+        conn (Connection): An open connection
+        table (str): Target table
+        columns (list[str]): Columns being inserted
+
+    Returns:
+        Insert: An insert statement, without conflict handling on dialects that do not support it
+    """
+    tbl = models.Base.metadata.tables[table]
+
+    if conn.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif conn.dialect.name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        return tbl.insert()
+
+    keys = conflict_columns(table)
+    stmt = dialect_insert(tbl)
+    return stmt.on_conflict_do_update(
+        index_elements=keys,
+        set_={c: stmt.excluded[c] for c in columns if c not in keys}
+    )
+
+
+def executemany_chunk(conn: Connection, table: str, columns: List[str], chunk: bytes, upsert: bool = False):
+    """Load CSV lines with a single executemany insert -- used for engines without COPY
+
+    Args:
+        conn (Connection): An open connection
+        table (str): Target table
+        columns (list[str]): Column names in file order
+        chunk (bytes): Complete CSV lines, without a header
+        upsert (bool, optional): Merge into existing rows. Defaults to False.
+    """
+    rows = [dict(zip(columns, r))
+            for r in csv.reader(io.TextIOWrapper(io.BytesIO(chunk), encoding='utf-8'))
+            if len(r) > 0]
+
+    if len(rows) == 0:
+        return
+
+    if is_compact(table):
+        stage = stage_table(conn, table)
+        conn.execute(sql_table(stage, *[sql_column(c) for c in columns]).insert(), rows)
+        merge_into(conn, table, stage, columns)
+    elif upsert:
+        conn.execute(upsert_statement(conn, table, columns), rows)
+    else:
+        conn.execute(sql_table(table, *[sql_column(c) for c in columns]).insert(), rows)
+
+
+def start_checkpoint(engine: Engine, aws_file_name: str, restart: bool = False) -> dict:
+    """Look up the load progress for a file
+
+    Args:
+        engine (Engine): Database engine
+        aws_file_name (str): Key of the file being loaded
+        restart (bool, optional): Ignore any saved progress. Defaults to False.
+
+    Returns:
+        dict: The saved checkpoint, or a new one starting at the beginning of the file
+    """
+    checkpoint = {
+        'aws_file_name': aws_file_name,
+        'columns': None,
+        'byte_offset': 0,
+        'n_rows': 0,
+        'accessions': [],
+        'completed': 0
+    }
+
+    if restart:
+        return checkpoint
+
+    tbl = models.IngestCheckpoint.__table__
+    with engine.connect() as conn:
+        row = conn.execute(
+            select(tbl).where(tbl.c.aws_file_name == aws_file_name)
+        ).mappings().first()
+
+    if row is not None:
+        checkpoint.update({k: row[k] for k in checkpoint if row[k] is not None})
+        if isinstance(checkpoint['columns'], str):
+            checkpoint['columns'] = checkpoint['columns'].split(',')
+        if isinstance(checkpoint['accessions'], str):
+            checkpoint['accessions'] = [a for a in checkpoint['accessions'].split(',') if a]
+
+    return checkpoint
+
+
+def save_checkpoint(conn: Connection, checkpoint: dict):
+    """Write load progress in the caller's transaction
+
+    Args:
+        conn (Connection): An open connection, inside the transaction that loaded the rows
+        checkpoint (dict): A checkpoint from start_checkpoint
+    """
+    tbl = models.IngestCheckpoint.__table__
+    values = {
+        'columns': ','.join(checkpoint['columns']),
+        'byte_offset': checkpoint['byte_offset'],
+        'n_rows': checkpoint['n_rows'],
+        'accessions': ','.join(sorted(checkpoint.get('accessions') or [])),
+        'completed': checkpoint['completed'],
+        'updated': datetime.utcnow()
+    }
+
+    res = conn.execute(
+        tbl.update().where(tbl.c.aws_file_name == checkpoint['aws_file_name']).values(**values)
+    )
+    if res.rowcount == 0:
+        conn.execute(tbl.insert().values(aws_file_name=checkpoint['aws_file_name'], **values))
+
+
+def load_expression_stream(engine: Engine,
+                           stream,
+                           method: str = 'copy',
+                           chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+                           table: str = models.GeneExpression.__tablename__,
+                           upsert: bool = False,
+                           checkpoint: Optional[dict] = None,
+                           log: Optional[Callable[[str], None]] = print) -> dict:
+    """Stream a CSV of gene expression values into the database
+
+    The stream is read one block at a time and every block is committed on its own,
+    so memory use is bounded by chunk_bytes regardless of the file size.
+
+    When a checkpoint is given, the byte offset, row count and studies seen are saved in
+    the same transaction as each block. If the checkpoint has a non-zero byte_offset the
+    stream must start at that offset (e.g. a ranged S3 GET) and has no header line. The
+    checkpoint is not marked completed -- call finish_checkpoint once the rows are visible.
+
+    Args:
+        engine (Engine): Database engine
+        stream (file-like): Binary stream, e.g. an S3 StreamingBody
+        method (str, optional): 'copy' to use COPY FROM STDIN (postgres only, falls back to
+            'executemany' on other engines) or 'executemany'. Defaults to 'copy'.
+        chunk_bytes (int, optional): Block size. Defaults to DEFAULT_CHUNK_BYTES.
+        table (str, optional): Target table. Defaults to gene_expression.
+        upsert (bool, optional): Overwrite rows that already exist. Defaults to False.
+        checkpoint (dict, optional): Progress record from start_checkpoint. Defaults to None.
+        log (Callable, optional): Progress callback. Defaults to print.
+
+    Returns:
+        dict: Number of rows loaded, elapsed seconds and rows per second
+    """
+    chunks = iter_line_chunks(stream, chunk_bytes)
+
+    if checkpoint is not None and checkpoint['byte_offset'] > 0:
+        columns, first = checkpoint['columns'], b''
+    else:
+        header, _, first = next(chunks, b'').partition(b'\n')
+        columns = parse_expression_header(header)
+
+        if checkpoint is not None:
+            checkpoint.update(columns=columns, byte_offset=len(header) + 1)
+
+    return load_chunks(engine, itertools.chain([first], chunks), columns,
+                       method=method, table=table, upsert=upsert, checkpoint=checkpoint, log=log)
+
+
+def finish_checkpoint(engine: Engine, checkpoint: dict):
+    """Record a file as loaded, once its rows are visible and its studies refreshed
+
+    Args:
+        engine (Engine): Database engine
+        checkpoint (dict): A checkpoint from start_checkpoint
+    """
+    checkpoint['completed'] = 1
+    with engine.begin() as conn:
+        save_checkpoint(conn, checkpoint)
+
+
+def load_chunks(engine: Engine,
+                chunks: Iterable[bytes],
+                columns: List[str],
+                method: str = 'copy',
+                table: str = models.GeneExpression.__tablename__,
+                upsert: bool = False,
+                checkpoint: Optional[dict] = None,
+                log: Optional[Callable[[str], None]] = print) -> dict:
+    """Load blocks of CSV lines, committing each block on its own
+
+    Args:
+        engine (Engine): Database engine
+        chunks (Iterable[bytes]): Blocks of complete CSV lines without a header
+        columns (list[str]): Column names in file order
+        method (str, optional): 'copy' or 'executemany'. Defaults to 'copy'.
+        table (str, optional): Target table. Defaults to gene_expression.
+        upsert (bool, optional): Overwrite rows that already exist. Defaults to False.
+        checkpoint (dict, optional): Progress record, saved with every block. Defaults to None.
+        log (Callable, optional): Progress callback. Defaults to print.
+
+    Returns:
+        dict: Number of rows loaded, elapsed seconds and rows per second
+    """
+    if method not in ('copy', 'executemany'):
+        raise ValueError(f"Unknown load method '{method}'")
+
+    if method == 'copy' and engine.dialect.name != 'postgresql':
+        method = 'executemany'
+
+    load_chunk = copy_chunk if method == 'copy' else executemany_chunk
+
+    start = time.perf_counter()
+    n_rows = 0
+
+    pattern = accession_pattern(columns)
+    accessions = set()
+
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+
+        chunk_rows = chunk.count(b'\n')
+        chunk_accessions = set(pattern.findall(chunk))
+        accessions.update(chunk_accessions)
+
+        with engine.begin() as conn:
+            load_chunk(conn, table, columns, chunk, upsert=upsert)
+
+            if checkpoint is not None:
+                checkpoint['byte_offset'] += len(chunk)
+                checkpoint['n_rows'] += chunk_rows
+                checkpoint['accessions'] = sorted(
+                    set(checkpoint['accessions']) | {a.decode('utf-8') for a in chunk_accessions})
+                save_checkpoint(conn, checkpoint)
+
+        n_rows += chunk_rows
+
+        if log is not None:
+            elapsed = time.perf_counter() - start
+            log(f"Loaded {n_rows} rows ({n_rows / max(elapsed, 1e-9):,.0f} rows/s)")
+
+    return load_stats(n_rows, time.perf_counter() - start, accessions)
+
+
+def load_stats(n_rows: int, seconds: float, accessions: Iterable = ()) -> dict:
+    return {
+        'rows': n_rows,
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(n_rows / seconds) if seconds > 0 else n_rows,
+        'accessions': sorted(a.decode('utf-8') if isinstance(a, bytes) else a for a in accessions)
+    }
+
+
+def study_counts_query(accessions: List[str]):
+    """Count rows and samples per study in the configured expression layout"""
+    if GENE_EXPRESSION_STORAGE == 'compact':
+        return select(
+            models.ExpressionStudy.accession_number,
+            func.count(),
+            func.count(models.GeneExpressionCompact.sample_key.distinct())
+        ).join(
+            models.ExpressionStudy,
+            models.ExpressionStudy.study_key == models.GeneExpressionCompact.study_key
+        ).where(
+            models.ExpressionStudy.accession_number.in_(accessions)
+        ).group_by(
+            models.ExpressionStudy.accession_number
+        )
+
+    return select(
+        models.GeneExpression.accession_number,
+        func.count(),
+        func.count(models.GeneExpression.sample_accession.distinct())
+    ).where(
+        models.GeneExpression.accession_number.in_(accessions)
+    ).group_by(
+        models.GeneExpression.accession_number
+    )
+
+
+def refresh_study_data(engine: Engine, accessions: Iterable[str]) -> int:
+    """Update the data summary and has_data flag for studies touched by a load
+
+    Only the given studies are recounted, each through an index range scan on its
+    accession, so the cost does not grow with the size of the expression table.
+
+    Args:
+        engine (Engine): Database engine
+        accessions (Iterable[str]): Accessions of the studies that were loaded
+
+    Returns:
+        int: Number of studies refreshed
+    """
+    accessions = sorted(set(accessions))
+    if len(accessions) == 0:
+        return 0
+
+    summary = models.StudyDataSummary.__table__
+    studies = models.Study.__table__
+
+    with engine.begin() as conn:
+        counts = {r[0]: (r[1], r[2]) for r in conn.execute(study_counts_query(accessions))}
+
+        for accession in accessions:
+            n_rows, n_samples = counts.get(accession, (0, 0))
+            values = {'n_rows': n_rows, 'n_samples': n_samples, 'updated': datetime.utcnow()}
+
+            res = conn.execute(
+                summary.update().where(
+                    summary.c.accession_number == accession
+                ).values(version=func.coalesce(summary.c.version, 0) + 1, **values)
+            )
+            if res.rowcount == 0:
+                conn.execute(summary.insert().values(accession_number=accession, version=1, **values))
+
+        conn.execute(
+            studies.update().where(
+                studies.c.external_db_id.in_([a for a in accessions if counts.get(a, (0,))[0] > 0])
+            ).values(has_data=1)
+        )
+        cache.bump_data_version(conn, cache.STUDIES)
+
+    return len(accessions)
+
+
+def bump_study_versions(conn: Connection, accessions: List[str]):
+    """Mark studies as changed without recounting them, e.g. after a sample metadata load"""
+    summary = models.StudyDataSummary.__table__
+
+    for accession in accessions:
+        res = conn.execute(
+            summary.update().where(
+                summary.c.accession_number == accession
+            ).values(version=func.coalesce(summary.c.version, 0) + 1, updated=datetime.utcnow())
+        )
+        if res.rowcount == 0:
+            conn.execute(summary.insert().values(accession_number=accession, n_rows=0, n_samples=0, version=1))
+
+
+def refresh_sample_documents(engine: Engine, accessions: Iterable[str]) -> int:
+    """Rebuild the per-sample metadata documents of the given studies from samples
+
+    Each study is replaced in its own transaction. The first value of a repeated
+    variable is kept, as in the metadata export.
+
+    Args:
+        engine (Engine): Database engine
+        accessions (Iterable[str]): Accessions of the studies whose sample metadata changed
+
+    Returns:
+        int: Number of documents written
+    """
+    documents = models.SampleDocument.__table__
+    samples = models.Sample.__table__
+    n_documents = 0
+
+    for accession in sorted(set(accessions)):
+        with engine.begin() as conn:
+            conn.execute(documents.delete().where(documents.c.accession_number == accession))
+
+            if conn.dialect.name == 'postgresql':
+                # jsonb keeps the last duplicate key, so aggregate newest first
+                res = conn.execute(text(f"""
+                insert into {documents.name} (accession_number, sample_accession, document, updated)
+                select accession_number, sample_accession, jsonb_object_agg(variable, value order by id desc), now()
+                from {samples.name}
+                where accession_number = :accession_number and variable is not null
+                group by accession_number, sample_accession
+                """), {'accession_number': accession})
+                n_documents += res.rowcount
+            else:
+                rows = conn.execute(
+                    select(samples.c.sample_accession, samples.c.variable, samples.c.value).where(
+                        samples.c.accession_number == accession,
+                        samples.c.variable.isnot(None)
+                    ).order_by(samples.c.sample_accession, samples.c.id)
+                )
+                batch = []
+                for sample_accession, group in itertools.groupby(rows, key=lambda r: r[0]):
+                    document = {}
+                    for _, variable, value in group:
+                        document.setdefault(variable, value)
+                    batch.append({'accession_number': accession, 'sample_accession': sample_accession,
+                                  'document': document, 'updated': datetime.utcnow()})
+                if len(batch) > 0:
+                    conn.execute(documents.insert(), batch)
+                n_documents += len(batch)
+
+            bump_study_versions(conn, [accession])
+            cache.bump_data_version(conn, cache.SAMPLES)
+
+    return n_documents
+
+
+def rebuild_study_data_summary(engine: Engine) -> int:
+    """Recount every study -- used to fill study_data_summary for data loaded before it existed
+
+    Args:
+        engine (Engine): Database engine
+
+    Returns:
+        int: Number of studies refreshed
+    """
+    if GENE_EXPRESSION_STORAGE == 'compact':
+        stmt = select(models.ExpressionStudy.accession_number)
+    else:
+        stmt = select(models.GeneExpression.accession_number.distinct())
+
+    with engine.connect() as conn:
+        accessions = [r[0] for r in conn.execute(stmt)]
+
+    return refresh_study_data(engine, accessions)
+
+
+#########################
+# range-partitioned loads
+#########################
+
+
+def plan_byte_ranges(first: int, size: int, n_parts: int) -> List[Tuple[int, int]]:
+    """Split the body of a file into contiguous byte ranges
+
+    Ranges are not aligned to lines here -- see iter_range_chunks.
+
+    Args:
+        first (int): Offset of the first data byte, i.e. the length of the header line
+        size (int): Size of the file in bytes
+        n_parts (int): Number of ranges
+
+    Returns:
+        list[tuple[int, int]]: (start, end) offsets, end exclusive
+    """
+    step = max(-(-(size - first) // max(n_parts, 1)), 1)
+    return [(s, min(s + step, size)) for s in range(first, size, step)]
+
+
+def iter_range_chunks(stream, start: int, end: int, chunk_bytes: int = DEFAULT_CHUNK_BYTES) -> Iterator[bytes]:
+    """Yield the lines that begin inside a byte range of a file
+
+    Every line belongs to the range containing its first byte, so ranges planned by
+    plan_byte_ranges cover each line exactly once.
+
+    Args:
+        stream (file-like): Binary stream positioned at byte start - 1 of the file
+        start (int): First byte of the range, must be > 0
+        end (int): End of the range, exclusive
+        chunk_bytes (int, optional): Block size. Defaults to DEFAULT_CHUNK_BYTES.
+
+    Yields:
+        bytes: Blocks of complete lines
+    """
+    offset = start - 1
+    skip = True
+
+    for chunk in iter_line_chunks(stream, chunk_bytes):
+        chunk_start = offset
+        offset += len(chunk)
+
+        # drop the tail of the line that began in the previous range
+        if skip:
+            cut = chunk.find(b'\n') + 1
+            chunk, chunk_start, skip = chunk[cut:], chunk_start + cut, False
+
+        if chunk_start >= end:
+            return
+
+        if chunk_start + len(chunk) <= end:
+            yield chunk
+            continue
+
+        # keep the line holding the last byte of the range, then stop
+        yield chunk[:chunk.find(b'\n', end - 1 - chunk_start) + 1]
+        return
+
+
+def create_staging_table(engine: Engine, staging: str, table: str = models.GeneExpression.__tablename__):
+    """Create an index-free copy of a table to load into
+
+    Args:
+        engine (Engine): Database engine
+        staging (str): Name of the new table
+        table (str, optional): Table to copy the columns of. Defaults to gene_expression.
+    """
+    with engine.begin() as conn:
+        conn.exec_driver_sql(f"drop table if exists {staging}")
+        if conn.dialect.name == 'postgresql':
+            conn.exec_driver_sql(f"create unlogged table {staging} (like {table} including defaults)")
+        else:
+            conn.exec_driver_sql(f"create table {staging} as select * from {table} where 1 = 0")
+
+
+def merge_staging_tables(engine: Engine,
+                         staging_tables: List[str],
+                         columns: List[str] = EXPRESSION_COLUMNS,
+                         table: str = models.GeneExpression.__tablename__):
+    """Upsert staging tables into the target table and drop them
+
+    Args:
+        engine (Engine): Database engine
+        staging_tables (list[str]): Tables from create_staging_table
+        columns (list[str], optional): Columns to copy. Defaults to EXPRESSION_COLUMNS.
+        table (str, optional): Target table. Defaults to gene_expression.
+    """
+    for staging in staging_tables:
+        with engine.begin() as conn:
+            merge_into(conn, table, staging, columns)
+            conn.exec_driver_sql(f"drop table {staging}")
+
+
+def drop_staging_tables(engine: Engine, staging_tables: List[str]):
+    """Drop staging tables that still exist, e.g. after a load failed part way
+
+    Args:
+        engine (Engine): Database engine
+        staging_tables (list[str]): Tables from create_staging_table
+    """
+    with engine.begin() as conn:
+        for staging in staging_tables:
+            conn.exec_driver_sql(f"drop table if exists {staging}")
+
+
+#########################
+# partitioned storage -- GENE_EXPRESSION_STORAGE = 'partitioned'
+#########################
+
+
+def is_partitioned() -> bool:
+    """True if gene_expression is list-partitioned by study"""
+    return GENE_EXPRESSION_STORAGE == 'partitioned'
+
+
+def load_table_name(aws_file_name: str, table: str = models.GeneExpression.__tablename__) -> str:
+    """Name of the standalone table a file is loaded into before it becomes partitions
+
+    The name only depends on the file, so a resumed load appends to the same table.
+    """
+    return f"{table}_load_{hashlib.sha1(aws_file_name.encode()).hexdigest()[:12]}"
+
+
+def partition_prefix(accession: str, table: str = models.GeneExpression.__tablename__) -> str:
+    """Prefix of the names of a study's partitions -- each swap appends a new suffix"""
+    return f"{table}_p_{hashlib.sha1(accession.encode()).hexdigest()[:12]}_"
+
+
+def sql_literal(value: str) -> str:
+    """Quote a string for DDL, which does not take bound parameters"""
+    return "'" + value.replace("'", "''") + "'"
+
+
+def find_partition(conn: Connection, accession: str, table: str = models.GeneExpression.__tablename__) -> Optional[str]:
+    """Name of the partition currently attached for a study, if any"""
+    prefix = partition_prefix(accession, table)
+    return conn.execute(text("""
+        select c.relname
+        from pg_inherits i
+        join pg_class c on c.oid = i.inhrelid
+        join pg_class p on p.oid = i.inhparent
+        where p.relname = :table and left(c.relname, length(:prefix)) = :prefix
+    """), {'table': table, 'prefix': prefix}).scalar()
+
+
+def check_partitioned(engine: Engine):
+    """Raise ValueError unless the partitioned layout is configured on a postgres database"""
+    if not is_partitioned():
+        raise ValueError("Set GENE_EXPRESSION_STORAGE = 'partitioned' to use partitioned storage")
+    if engine.dialect.name != 'postgresql':
+        raise ValueError("GENE_EXPRESSION_STORAGE = 'partitioned' requires postgresql")
+
+
+def build_study_partition(engine: Engine,
+                          accession: str,
+                          sources: List[str],
+                          columns: List[str] = EXPRESSION_COLUMNS,
+                          table: str = models.GeneExpression.__tablename__) -> Tuple[str, int]:
+    """Copy one study out of the loaded tables into a new standalone table, ready to attach
+
+    The new table gets the parent's primary key and indexes, so attaching it adopts them,
+    and a check constraint on accession_number, so attaching it does not scan it.
+
+    Args:
+        engine (Engine): Database engine
+        accession (str): The study to copy
+        sources (list[str]): Loaded tables, e.g. from create_staging_table
+        columns (list[str], optional): Columns to copy. Defaults to EXPRESSION_COLUMNS.
+        table (str, optional): Partitioned parent. Defaults to gene_expression.
+
+    Returns:
+        tuple[str, int]: Name of the new table and its number of rows
+    """
+    new = f"{partition_prefix(accession, table)}{uuid.uuid4().hex[:8]}"
+    col_list = ', '.join(columns)
+    source = ' union all '.join(f"select {col_list} from {s} where accession_number = :accession" for s in sources)
+    key = ', '.join(conflict_columns(table))
+
+    with engine.begin() as conn:
+        conn.exec_driver_sql(f"create table {new} (like {table} including defaults)")
+        # a row loaded twice keeps one value, as the upsert does
+        res = conn.execute(text(f"""
+            insert into {new} ({col_list})
+            select distinct on ({key}) {col_list} from ({source}) s
+        """), {'accession': accession})
+        conn.exec_driver_sql(f"alter table {new} add primary key ({key})")
+        for index in models.GeneExpression.__table__.indexes:
+            conn.exec_driver_sql(f"create index on {new} ({', '.join(c.name for c in index.columns)})")
+        conn.exec_driver_sql(f"create index on {new} ({models.GENE_ORDER_INDEXES[table][1]})")
+        conn.exec_driver_sql(
+            f"alter table {new} add constraint {new}_study check (accession_number = {sql_literal(accession)})")
+        conn.exec_driver_sql(f"analyze {new}")
+
+    return new, res.rowcount
+
+
+def swap_study_partitions(engine: Engine,
+                          sources: List[str],
+                          columns: List[str] = EXPRESSION_COLUMNS,
+                          table: str = models.GeneExpression.__tablename__,
+                          log: Optional[Callable[[str], None]] = print,
+                          accessions: Optional[List[str]] = None) -> List[str]:
+    """Replace the partition of every study in the loaded tables
+
+    Each study is built in a standalone table first. Detaching the old partition,
+    attaching the new one and dropping the old one then happen in one short transaction,
+    so readers see either the old or the new data for a study, never a mix.
+
+    Args:
+        engine (Engine): Database engine
+        sources (list[str]): Loaded tables, e.g. from create_staging_table
+        columns (list[str], optional): Columns to copy. Defaults to EXPRESSION_COLUMNS.
+        table (str, optional): Partitioned parent. Defaults to gene_expression.
+        log (Callable, optional): Progress callback. Defaults to print.
+        accessions (list[str], optional): Studies to swap. Defaults to every study in the loaded tables.
+
+    Returns:
+        list[str]: Accessions of the swapped studies
+    """
+    check_partitioned(engine)
+
+    if accessions is None:
+        with engine.connect() as conn:
+            union = ' union '.join(f"select distinct accession_number from {s}" for s in sources)
+            accessions = sorted(r[0] for r in conn.exec_driver_sql(union))
+
+    for accession in accessions:
+        new, n_rows = build_study_partition(engine, accession, sources, columns, table)
+
+        with engine.begin() as conn:
+            old = find_partition(conn, accession, table)
+            if old is not None:
+                conn.exec_driver_sql(f"alter table {table} detach partition {old}")
+            conn.exec_driver_sql(
+                f"alter table {table} attach partition {new} for values in ({sql_literal(accession)})")
+            if old is not None:
+                conn.exec_driver_sql(f"drop table {old}")
+
+        if log is not None:
+            log(f"{accession}: attached {n_rows} rows as {new}" + (f", dropped {old}" if old else ""))
+
+    return accessions
+
+
+def drop_study_partition(engine: Engine, accession: str, table: str = models.GeneExpression.__tablename__) -> bool:
+    """Delete a study's expression data by dropping its partition
+
+    Args:
+        engine (Engine): Database engine
+        accession (str): The study to delete
+        table (str, optional): Partitioned parent. Defaults to gene_expression.
+
+    Returns:
+        bool: False if the study had no partition
+    """
+    check_partitioned(engine)
+
+    with engine.begin() as conn:
+        partition = find_partition(conn, accession, table)
+        if partition is None:
+            return False
+        conn.exec_driver_sql(f"alter table {table} detach partition {partition}")
+        conn.exec_driver_sql(f"drop table {partition}")
+
+    return True
+
+
+def delete_study_expression(engine: Engine, accession: str) -> bool:
+    """Delete a study's expression data in whichever layout is configured, and clear its has_data flag
+
+    Args:
+        engine (Engine): Database engine
+        accession (str): The study to delete
+
+    Returns:
+        bool: False if the study had no expression data
+    """
+    table = models.GeneExpression.__tablename__
+
+    if is_partitioned():
+        deleted = drop_study_partition(engine, accession, table)
+    else:
+        with engine.begin() as conn:
+            if is_compact(table):
+                study_keys = select(models.ExpressionStudy.study_key).where(
+                    models.ExpressionStudy.accession_number == accession)
+                res = conn.execute(models.GeneExpressionCompact.__table__.delete().where(
+                    models.GeneExpressionCompact.study_key.in_(study_keys)))
+            else:
+                res = conn.execute(models.GeneExpression.__table__.delete().where(
+                    models.GeneExpression.accession_number == accession))
+        deleted = res.rowcount > 0
+
+    with engine.begin() as conn:
+        studies = models.Study.__table__
+        conn.execute(studies.update().where(studies.c.external_db_id == accession).values(has_data=0))
+
+    return deleted
+
+
+def partition_expression_table(engine: Engine,
+                               drop_source: bool = False,
+                               table: str = models.GeneExpression.__tablename__,
+                               log: Optional[Callable[[str], None]] = print) -> dict:
+    """Move an unpartitioned gene_expression table into the partitioned layout
+
+    The old table is renamed and the partitioned parent is created in its place, in one
+    transaction. Every study is then copied into its own partition. Until the last one
+    is attached, readers only see the studies moved so far, so run this in a maintenance
+    window with ingestion stopped.
+
+    A run that failed part way is resumed. If the renamed table exists, it is used as the
+    source again, and studies that already have a partition are skipped.
+
+    Args:
+        engine (Engine): Database engine
+        drop_source (bool, optional): Drop the renamed old table afterwards. Defaults to False.
+        table (str, optional): Table to partition. Defaults to gene_expression.
+        log (Callable, optional): Progress callback. Defaults to print.
+
+    Returns:
+        dict: Name of the old table, the number of studies moved and the number already moved by an earlier run
+    """
+    check_partitioned(engine)
+    source = f"{table}_unpartitioned"
+
+    with engine.begin() as conn:
+        kinds = dict(conn.execute(text(
+            "select relname, relkind from pg_class where relname in (:table, :source) and relkind in ('r', 'p')"
+        ), {'table': table, 'source': source}).all())
+
+        if source not in kinds:
+            if kinds.get(table) == 'p':
+                # already partitioned, and the old table was dropped
+                return {'source': None, 'studies': 0, 'skipped': 0}
+
+            conn.exec_driver_sql(f"alter table {table} rename to {source}")
+            # index names are global, so free them for the new parent
+            conn.exec_driver_sql(f"alter index if exists {table}_pkey rename to {source}_pkey")
+            for index in [i.name for i in models.GeneExpression.__table__.indexes] + [models.GENE_ORDER_INDEXES[table][0]]:
+                conn.exec_driver_sql(f"alter index if exists {index} rename to {source}_{index}")
+
+        if kinds.get(table) != 'p':
+            models.GeneExpression.__table__.create(conn)
+
+    with engine.connect() as conn:
+        studies = sorted(r[0] for r in conn.exec_driver_sql(f"select distinct accession_number from {source}"))
+        pending = [a for a in studies if find_partition(conn, a, table) is None]
+
+    if log is not None and len(pending) < len(studies):
+        log(f"Resuming: {len(studies) - len(pending)} of {len(studies)} studies already moved")
+
+    accessions = swap_study_partitions(engine, [source], table=table, log=log, accessions=pending)
+
+    if drop_source:
+        with engine.begin() as conn:
+            conn.exec_driver_sql(f"drop table {source}")
+
+    return {'source': source, 'studies': len(accessions), 'skipped': len(studies) - len(pending)}
@@ -0,0 +1,300 @@
+"""Versioned schema migrations and index maintenance
+
+Run pending migrations before starting the API or the workers:
+
+    python -m db_utils.migrations upgrade
+
+`status` lists applied and pending migrations, and `report` lists unused and
+missing indexes from the planner's statistics.
+"""
+import argparse
+import json
+
+from datetime import datetime
+from typing import Callable, List, Optional
+
+from sqlalchemy import Column, Index, inspect, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateIndex
+
+from . import models
+from .database import engine as default_engine
+
+
+def index_exists(conn, name: str) -> bool:
+    """True if an index of this name exists -- invalid postgres indexes count as missing"""
+    if conn.dialect.name == 'postgresql':
+        return conn.execute(text("""
+            select 1 from pg_class c join pg_index i on i.indexrelid = c.oid
+            where c.relname = :name and i.indisvalid
+        """), {'name': name}).first() is not None
+
+    return conn.execute(text(
+        "select 1 from sqlite_master where type = 'index' and name = :name"
+    ), {'name': name}).first() is not None
+
+
+def is_partitioned_table(conn, table: str) -> bool:
+    """True if a postgres table is a partitioned parent, which cannot be indexed CONCURRENTLY"""
+    return bool(conn.execute(text(
+        "select relkind = 'p' from pg_class where relname = :table"
+    ), {'table': table}).scalar())
+
+
+def create_index(engine: Engine, index: Index, log: Optional[Callable[[str], None]] = print) -> bool:
+    """Create a model index if it is missing, without blocking writes on postgres
+
+    Postgres builds the index CONCURRENTLY, outside a transaction. A build that failed
+    part way leaves an invalid index, which is dropped and built again. Partitioned
+    tables do not support CONCURRENTLY, so their indexes are built normally.
+
+    Args:
+        engine (Engine): Database engine
+        index (Index): An index declared on a model
+        log (Callable, optional): Progress callback. Defaults to print.
+
+    Returns:
+        bool: False if the index already existed
+    """
+    with engine.connect() as conn:
+        if index_exists(conn, index.name):
+            return False
+
+    ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=engine.dialect))
+
+    if engine.dialect.name == 'postgresql':
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            concurrently = '' if is_partitioned_table(conn, index.table.name) else 'concurrently '
+            conn.exec_driver_sql(f"drop index {concurrently}if exists {index.name}")
+            conn.exec_driver_sql(ddl.replace('INDEX ', f"INDEX {concurrently.upper()}", 1))
+    else:
+        with engine.begin() as conn:
+            conn.exec_driver_sql(ddl)
+
+    if log is not None:
+        log(f"Created index {index.name}")
+    return True
+
+
+def create_model_indexes(engine: Engine, tables: List[str], log: Optional[Callable[[str], None]] = print) -> int:
+    """Create the missing indexes declared on the models of the given tables
+
+    Args:
+        engine (Engine): Database engine
+        tables (list[str]): Table names
+        log (Callable, optional): Progress callback. Defaults to print.
+
+    Returns:
+        int: Number of indexes created
+    """
+    n_created = 0
+    for table in tables:
+        for index in sorted(models.Base.metadata.tables[table].indexes, key=lambda i: i.name):
+            n_created += create_index(engine, index, log)
+    return n_created
+
+
+def add_column(engine: Engine, column: Column) -> bool:
+    """Add a model column to its table if the table was created without it
+
+    Args:
+        engine (Engine): Database engine
+        column (Column): A column declared on a model
+
+    Returns:
+        bool: False if the column already existed
+    """
+    table = column.table.name
+    if column.name in [c['name'] for c in inspect(engine).get_columns(table)]:
+        return False
+
+    column_type = column.type.compile(dialect=engine.dialect)
+    with engine.begin() as conn:
+        conn.exec_driver_sql(f"alter table {table} add column {column.name} {column_type}")
+    return True
+
+
+#########################
+# migrations -- append new ones, never edit or reorder applied ones
+#########################
+
+
+def create_tables(engine: Engine):
+    # new tables are empty, so their indexes are created with them
+    models.Base.metadata.create_all(bind=engine)
+
+
+def create_study_indexes(engine: Engine):
+    create_model_indexes(engine, [models.Study.__tablename__])
+
+    if engine.dialect.name == 'postgresql':
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            for statement in models.STUDY_SEARCH_DDL['postgresql']:
+                conn.exec_driver_sql(statement.replace('create index ', 'create index concurrently ', 1))
+    elif engine.dialect.name == 'sqlite':
+        with engine.begin() as conn:
+            for statement in models.STUDY_SEARCH_DDL['sqlite']:
+                conn.exec_driver_sql(statement)
+            conn.exec_driver_sql("insert into studies_fts(studies_fts) values ('rebuild')")
+
+
+def create_data_indexes(engine: Engine):
+    create_model_indexes(engine, [models.Sample.__tablename__,
+                                  models.GeneExpression.__tablename__,
+                                  models.GeneExpressionCompact.__tablename__])
+
+
+def add_checkpoint_accessions(engine: Engine):
+    add_column(engine, models.IngestCheckpoint.__table__.c.accessions)
+
+
+def replace_sample_value_indexes(engine: Engine):
+    # samples.value can exceed the postgres index row size -- index its key, not the value
+    if engine.dialect.name == 'postgresql':
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.exec_driver_sql("drop index concurrently if exists ix_samples_accession_variable_value")
+            covering = conn.execute(text("""
+                select 1 from pg_class c join pg_index i on i.indexrelid = c.oid
+                where c.relname = 'ix_samples_accession_sample' and i.indnatts > i.indnkeyatts
+            """)).first()
+            if covering is not None:
+                conn.exec_driver_sql("drop index concurrently ix_samples_accession_sample")
+    else:
+        with engine.begin() as conn:
+            conn.exec_driver_sql("drop index if exists ix_samples_accession_variable_value")
+
+    create_model_indexes(engine, [models.Sample.__tablename__])
+
+
+def create_gene_order_indexes(engine: Engine):
+    # ordered expression reads stream from these instead of sorting every row of a study
+    if engine.dialect.name != 'postgresql':
+        return
+
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        for table, (name, columns) in models.GENE_ORDER_INDEXES.items():
+            if index_exists(conn, name):
+                continue
+            concurrently = '' if is_partitioned_table(conn, table) else 'concurrently '
+            conn.exec_driver_sql(f"drop index {concurrently}if exists {name}")
+            conn.exec_driver_sql(f"create index {concurrently}{name} on {table} ({columns})")
+            print(f"Created index {name}")
+
+
+MIGRATIONS = [
+    (1, "create missing tables", create_tables),
+    (2, "study search and filter indexes", create_study_indexes),
+    (3, "sample metadata and expression indexes", create_data_indexes),
+    (4, "studies seen by resumable loads", add_checkpoint_accessions),
+    (5, "sample indexes on value keys", replace_sample_value_indexes),
+    (6, "expression indexes in byte order", create_gene_order_indexes),
+]
+
+
+def applied_versions(engine: Engine) -> dict:
+    """Applied migration versions and when they were applied"""
+    models.SchemaMigration.__table__.create(engine, checkfirst=True)
+
+    with engine.connect() as conn:
+        rows = conn.execute(select(models.SchemaMigration.version, models.SchemaMigration.applied))
+        return {r[0]: r[1] for r in rows}
+
+
+def upgrade(engine: Engine = default_engine, log: Optional[Callable[[str], None]] = print) -> List[int]:
+    """Apply pending migrations in order, recording each one once it has succeeded
+
+    Args:
+        engine (Engine, optional): Database engine. Defaults to the API engine.
+        log (Callable, optional): Progress callback. Defaults to print.
+
+    Returns:
+        list[int]: Versions applied
+    """
+    applied = applied_versions(engine)
+    versions = []
+
+    for version, description, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+
+        if log is not None:
+            log(f"Applying migration {version}: {description}")
+        migrate(engine)
+
+        with engine.begin() as conn:
+            conn.execute(models.SchemaMigration.__table__.insert().values(
+                version=version, description=description, applied=datetime.utcnow()))
+        versions.append(version)
+
+    return versions
+
+
+def status(engine: Engine = default_engine) -> List[dict]:
+    """Every migration and when it was applied, None if pending"""
+    applied = applied_versions(engine)
+    return [{'version': version, 'description': description, 'applied': applied.get(version)}
+            for version, description, _ in MIGRATIONS]
+
+
+def index_report(engine: Engine = default_engine, min_rows: int = 10000) -> dict:
+    """Report unused and missing indexes
+
+    Declared model indexes that do not exist are always reported. On postgres, the
+    statistics collector also gives indexes never scanned since the statistics were
+    last reset, and tables of at least min_rows rows read by sequential scans more
+    often than by index scans.
+
+    Args:
+        engine (Engine, optional): Database engine. Defaults to the API engine.
+        min_rows (int, optional): Smallest table to report sequential scans for. Defaults to 10000.
+
+    Returns:
+        dict: Lists of missing, unused and sequentially scanned entries
+    """
+    report = {'missing': [], 'unused': [], 'sequential_scans': []}
+
+    with engine.connect() as conn:
+        for table in models.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                if not index_exists(conn, index.name):
+                    report['missing'].append({'table': table.name, 'index': index.name})
+
+        if conn.dialect.name != 'postgresql':
+            return report
+
+        for table, (name, _) in models.GENE_ORDER_INDEXES.items():
+            if not index_exists(conn, name):
+                report['missing'].append({'table': table, 'index': name})
+
+        rows = conn.execute(text("""
+            select s.relname, s.indexrelname, s.idx_scan, pg_relation_size(s.indexrelid)
+            from pg_stat_user_indexes s join pg_index i on i.indexrelid = s.indexrelid
+            where s.idx_scan = 0 and not i.indisunique and not i.indisprimary
+            order by pg_relation_size(s.indexrelid) desc
+        """))
+        report['unused'] = [{'table': r[0], 'index': r[1], 'scans': r[2], 'bytes': r[3]} for r in rows]
+
+        rows = conn.execute(text("""
+            select relname, seq_scan, seq_tup_read, coalesce(idx_scan, 0), n_live_tup
+            from pg_stat_user_tables
+            where seq_scan > coalesce(idx_scan, 0) and n_live_tup >= :min_rows
+            order by seq_tup_read desc
+        """), {'min_rows': min_rows})
+        report['sequential_scans'] = [{'table': r[0], 'seq_scans': r[1], 'rows_read': r[2],
+                                       'index_scans': r[3], 'rows': r[4]} for r in rows]
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Manage the gene expression database schema")
+    parser.add_argument('command', choices=['upgrade', 'status', 'report'])
+    args = parser.parse_args()
+
+    if args.command == 'upgrade':
+        applied = upgrade()
+        print(f"Applied {len(applied)} migration(s)")
+    elif args.command == 'status':
+        print(json.dumps(status(), indent=2, default=str))
+    else:
+        print(json.dumps(index_report(), indent=2, default=str))
@@ -1,6 +1,10 @@
-from sqlalchemy import Column, Integer, String
+from datetime import datetime
+from sqlalchemy import BigInteger, Column, DateTime, DDL, ForeignKey, Index, Integer, JSON, REAL, String, event, text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
 
-from .database import Base
+from .database import Base, GENE_EXPRESSION_STORAGE
 
 class Study(Base):
 
@@ -22,6 +26,54 @@ class Study(Base):
     gds_type = Column(String, default=None)
     has_data = Column(Integer, default=0)
 
+    __table_args__ = (
+        # study search filters, most selective equality columns first and the sample range last
+        Index("ix_studies_filters", "has_data", "organism_name", "gds_type", "n_samples"),
+        Index("ix_studies_profiling_method", "gds_type", "n_samples"),
+        # the frontend only searches studies with data
+        Index("ix_studies_with_data", "organism_name", "gds_type", "n_samples",
+              postgresql_where=text("has_data = 1"), sqlite_where=text("has_data = 1")),
+    )
+
+# full-text study search over title, description and organization
+# postgres matches against a GIN expression index -- queries must use STUDY_SEARCH_DOCUMENT verbatim
+# sqlite keeps an external-content FTS5 table in sync with studies through triggers
+
+STUDY_SEARCH_CONFIG = "'english'"
+
+STUDY_SEARCH_DOCUMENT = (
+    f"to_tsvector({STUDY_SEARCH_CONFIG}, coalesce(title, '') || ' ' || "
+    "coalesce(description, '') || ' ' || coalesce(organization, ''))"
+)
+
+STUDY_SEARCH_DDL = {
+    'postgresql': [
+        f"create index if not exists ix_studies_search on studies using gin ({STUDY_SEARCH_DOCUMENT})",
+    ],
+    'sqlite': [
+        """create virtual table if not exists studies_fts using fts5(
+            title, description, organization, content='studies', content_rowid='study_id')""",
+        """create trigger if not exists studies_fts_insert after insert on studies begin
+            insert into studies_fts(rowid, title, description, organization)
+            values (new.study_id, new.title, new.description, new.organization);
+        end""",
+        """create trigger if not exists studies_fts_delete after delete on studies begin
+            insert into studies_fts(studies_fts, rowid, title, description, organization)
+            values ('delete', old.study_id, old.title, old.description, old.organization);
+        end""",
+        """create trigger if not exists studies_fts_update after update on studies begin
+            insert into studies_fts(studies_fts, rowid, title, description, organization)
+            values ('delete', old.study_id, old.title, old.description, old.organization);
+            insert into studies_fts(rowid, title, description, organization)
+            values (new.study_id, new.title, new.description, new.organization);
+        end""",
+    ],
+}
+
+for dialect, statements in STUDY_SEARCH_DDL.items():
+    for statement in statements:
+        event.listen(Study.__table__, 'after_create', DDL(statement).execute_if(dialect=dialect))
+
 class Sample(Base):
 
     __tablename__ = "samples"
@@ -32,6 +84,40 @@ class Sample(Base):
     variable = Column(String)
     value = Column(String, default = "")
 
+    __table_args__ = (
+        # per-sample metadata reads of a study -- value is not included, it can exceed the index row size
+        Index("ix_samples_accession_sample", "accession_number", "sample_accession"),
+    )
+
+class sample_value_key(FunctionElement):
+    """Indexable form of samples.value -- md5 on postgres, whose btree entries are limited to about
+    2.7 KB while GEO protocol and description values run to several KB; the value itself elsewhere"""
+    name = 'sample_value_key'
+    inherit_cache = True
+
+@compiles(sample_value_key)
+def compile_sample_value_key(element, compiler, **kw):
+    return compiler.process(element.clauses, **kw)
+
+@compiles(sample_value_key, 'postgresql')
+def compile_sample_value_key_postgresql(element, compiler, **kw):
+    return f"md5({compiler.process(element.clauses, **kw)})"
+
+# metadata predicates in data queries, see crud.sample_filter_condition
+Index("ix_samples_accession_variable_value_key",
+      Sample.accession_number, Sample.variable, sample_value_key(Sample.value))
+
+class SampleDocument(Base):
+
+    # one row per sample with all of its metadata variables, kept in sync with samples at ingest
+
+    __tablename__ = "sample_documents"
+
+    accession_number = Column(String, primary_key=True)
+    sample_accession = Column(String, primary_key=True)
+    document = Column(JSON().with_variant(JSONB, 'postgresql'))
+    updated = Column(DateTime, default=datetime.utcnow)
+
 class GeneExpression(Base):
 
     __tablename__ = "gene_expression"
@@ -41,4 +127,104 @@ class GeneExpression(Base):
     sample_accession = Column(String, primary_key=True)
     value = Column(String)
 
-    
\ No newline at end of file
+    __table_args__ = (
+        # sample subsets within a study -- gene subsets use the primary key
+        Index("ix_gene_expression_accession_sample", "accession_number", "sample_accession"),
+        # one list partition per study in the 'partitioned' layout, see loaders.swap_study_partitions
+        {'postgresql_partition_by': 'LIST (accession_number)'} if GENE_EXPRESSION_STORAGE == 'partitioned' else {},
+    )
+
+# compact expression storage -- see GENE_EXPRESSION_STORAGE in database.py
+# accessions and genes are stored once in dictionary tables and referenced by integer keys
+
+class ExpressionStudy(Base):
+
+    __tablename__ = "expression_studies"
+
+    study_key = Column(Integer, primary_key=True, autoincrement=True)
+    accession_number = Column(String, unique=True, nullable=False)
+
+class ExpressionGene(Base):
+
+    __tablename__ = "expression_genes"
+
+    gene_key = Column(Integer, primary_key=True, autoincrement=True)
+    gene = Column(String, unique=True, nullable=False)
+
+class ExpressionSample(Base):
+
+    __tablename__ = "expression_samples"
+
+    sample_key = Column(Integer, primary_key=True, autoincrement=True)
+    sample_accession = Column(String, unique=True, nullable=False)
+
+class GeneExpressionCompact(Base):
+
+    __tablename__ = "gene_expression_compact"
+
+    study_key = Column(Integer, ForeignKey("expression_studies.study_key"), primary_key=True)
+    gene_key = Column(Integer, ForeignKey("expression_genes.gene_key"), primary_key=True)
+    sample_key = Column(Integer, ForeignKey("expression_samples.sample_key"), primary_key=True)
+    value = Column(REAL)
+
+    __table_args__ = (
+        Index("ix_gene_expression_compact_study_sample", "study_key", "sample_key"),
+    )
+
+# ordered expression reads -- archives.matrix_rows merges studies in python string order, which is
+# byte order under the "C" collation, so postgres indexes gene in that collation to stream rows in
+# index order instead of sorting each study. other databases compare bytes, the keys above suffice
+
+GENE_ORDER_INDEXES = {
+    GeneExpression.__tablename__: ("ix_gene_expression_accession_gene_c",
+                                   'accession_number, gene collate "C", sample_accession'),
+    ExpressionGene.__tablename__: ("ix_expression_genes_gene_c", 'gene collate "C"'),
+}
+
+for table_name, (index_name, index_columns) in GENE_ORDER_INDEXES.items():
+    event.listen(Base.metadata.tables[table_name], 'after_create',
+                 DDL(f"create index if not exists {index_name} on {table_name} ({index_columns})"
+                     ).execute_if(dialect='postgresql'))
+
+class StudyDataSummary(Base):
+
+    __tablename__ = "study_data_summary"
+
+    accession_number = Column(String, primary_key=True)
+    n_rows = Column(BigInteger, default=0)
+    n_samples = Column(Integer, default=0)
+    version = Column(Integer, default=0)
+    updated = Column(DateTime, default=datetime.utcnow)
+
+class IngestCheckpoint(Base):
+
+    __tablename__ = "ingest_checkpoints"
+
+    aws_file_name = Column(String, primary_key=True)
+    columns = Column(String)
+    byte_offset = Column(BigInteger, default=0)
+    n_rows = Column(BigInteger, default=0)
+    # studies seen in the committed blocks, comma separated -- a resumed load only reads the rest of the file
+    accessions = Column(String)
+    completed = Column(Integer, default=0)
+    updated = Column(DateTime, default=datetime.utcnow)
+
+class DataVersion(Base):
+
+    # counters bumped by ingestion -- cached lookups are keyed by these, see cache.py
+
+    __tablename__ = "data_versions"
+
+    scope = Column(String, primary_key=True)
+    version = Column(Integer, default=0, nullable=False)
+    updated = Column(DateTime, default=datetime.utcnow)
+
+class SchemaMigration(Base):
+
+    # migrations applied to this database -- see migrations.py
+
+    __tablename__ = "schema_migrations"
+
+    version = Column(Integer, primary_key=True)
+    description = Column(String)
+    applied = Column(DateTime, default=datetime.utcnow)
@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+# connection pool settings, shared by the API and the Celery worker processes
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE') or 5)
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW') or 10)
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT') or 30)
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE') or 1800)
+DB_POOL_PRE_PING = (os.environ.get('DB_POOL_PRE_PING') or 'true').lower() in ('1', 'true', 'yes')
+
+
+class TimedPoolMixin:
+    """Count checkouts and the time spent waiting for a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timings_lock = threading.Lock()
+        self.n_checkouts = 0
+        self.n_timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def recreate(self):
+        # engine.dispose() swaps in a new pool -- keep counting across it
+        pool = super().recreate()
+        pool.n_checkouts, pool.n_timeouts = self.n_checkouts, self.n_timeouts
+        pool.wait_seconds, pool.max_wait_seconds = self.wait_seconds, self.max_wait_seconds
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            with self.timings_lock:
+                self.n_timeouts += 1
+            raise
+        finally:
+            wait = time.perf_counter() - start
+            with self.timings_lock:
+                self.n_checkouts += 1
+                self.wait_seconds += wait
+                self.max_wait_seconds = max(self.max_wait_seconds, wait)
+
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def pool_options(url, asynchronous: bool = False) -> dict:
+    """create_engine pool arguments for a database url
+
+    SQLite keeps SQLAlchemy's default pool, which does not take size limits.
+
+    Args:
+        url (str): A database url
+        asynchronous (bool, optional): Options for create_async_engine. Defaults to False.
+
+    Returns:
+        dict: Keyword arguments for create_engine
+    """
+    if make_url(url).get_backend_name() == 'sqlite':
+        return {'pool_pre_ping': DB_POOL_PRE_PING}
+
+    return {
+        'poolclass': TimedAsyncAdaptedQueuePool if asynchronous else TimedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+    }
+
+
+def create_pooled_engine(url=None) -> Engine:
+    """Create an engine with the configured connection pool
+
+    Args:
+        url (str, optional): A database url. Defaults to SQLALCHEMY_DATABASE_URL.
+
+    Returns:
+        Engine: The engine
+    """
+    url = url or os.environ.get('SQLALCHEMY_DATABASE_URL')
+    return create_engine(url, **pool_options(url))
+
+
+def pool_stats(engine: Engine) -> dict:
+    """Connection pool statistics of an engine
+
+    Args:
+        engine (Engine): A sync engine, or the sync_engine of an async one
+
+    Returns:
+        dict: Pool size and current use, plus checkout counts and wait times for timed pools
+    """
+    pool = engine.pool
+    stats = {'pool': type(pool).__name__, 'status': pool.status()}
+
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0),
+            'max_overflow': pool._max_overflow,
+        })
+
+    if isinstance(pool, TimedPoolMixin):
+        with pool.timings_lock:
+            stats.update({
+                'checkouts': pool.n_checkouts,
+                'timeouts': pool.n_timeouts,
+                'wait_seconds': round(pool.wait_seconds, 6),
+                'mean_wait_seconds': round(pool.wait_seconds / pool.n_checkouts, 6) if pool.n_checkouts else 0.0,
+                'max_wait_seconds': round(pool.max_wait_seconds, 6),
+            })
+
+    return stats
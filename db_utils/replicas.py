@@ -0,0 +1,155 @@
+import itertools
+import os
+import threading
+import time
+
+from typing import List, Optional
+
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from .pools import pool_options
+
+# read-only replicas of SQLALCHEMY_DATABASE_URL, comma separated -- empty reads from the primary
+READ_DATABASE_URLS = [u.strip() for u in (os.environ.get('SQLALCHEMY_READ_DATABASE_URLS') or '').split(',') if u.strip()]
+
+# seconds a replica may fall behind the primary before reads go elsewhere
+READ_REPLICA_MAX_LAG = float(os.environ.get('READ_REPLICA_MAX_LAG') or 30)
+
+# seconds between replication lag checks
+READ_REPLICA_CHECK_INTERVAL = float(os.environ.get('READ_REPLICA_CHECK_INTERVAL') or 5)
+
+# a replica that has replayed everything it received is current, even if the primary has been idle
+POSTGRES_LAG = text("""
+    select case
+        when not pg_is_in_recovery() or pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() then 0
+        else extract(epoch from now() - pg_last_xact_replay_timestamp())
+    end
+""")
+
+
+def data_versions_statement():
+    # imported here, since models imports database, which builds the replica sets
+    from . import models
+    return select(models.DataVersion.scope, models.DataVersion.version)
+
+
+def replay_lag(seconds) -> float:
+    """Lag of a postgres replica -- one that has not replayed any transaction yet is not usable"""
+    return float('inf') if seconds is None else float(seconds)
+
+
+def versions_lag(replica_versions, primary_versions) -> float:
+    """Lag of a replica that has no replication statistics -- 0 if its data versions match the primary's"""
+    return 0.0 if dict(replica_versions) == dict(primary_versions) else float('inf')
+
+
+class ReplicaSet:
+    """Read-only engines, chosen round robin among those close enough to the primary
+
+    On postgres, the lag of a replica is the time since the last transaction it replayed,
+    unless it has replayed everything it received. Other databases have no replication
+    statistics, so a replica lags if its data versions differ from the primary's -- this
+    is what lets two sqlite files stand in for a primary and a replica.
+
+    Replicas that lag more than READ_REPLICA_MAX_LAG, or cannot be reached, are skipped
+    until the next check. Without a usable replica, reads go to the primary.
+    """
+
+    def __init__(self, primary, urls: List[str], asynchronous: bool = False):
+        self.primary = primary
+        if asynchronous:
+            self.replicas = [create_async_engine(url, **pool_options(url, asynchronous=True)) for url in urls]
+        else:
+            self.replicas = [create_engine(url, **pool_options(url)) for url in urls]
+
+        self.lags: List[Optional[float]] = [None] * len(self.replicas)
+        self.checked = None
+        self.lock = threading.Lock()
+        self.turns = itertools.count()
+
+    def due(self) -> bool:
+        """Start a lag check if the last one is older than READ_REPLICA_CHECK_INTERVAL"""
+        if not self.replicas:
+            return False
+
+        now = time.monotonic()
+        with self.lock:
+            if self.checked is not None and now - self.checked < READ_REPLICA_CHECK_INTERVAL:
+                return False
+            self.checked = now
+        return True
+
+    def record(self, lags: List[Optional[float]]):
+        for url, old, new in zip(self.urls(), self.lags, lags):
+            if (old is None or old > READ_REPLICA_MAX_LAG) != (new is None or new > READ_REPLICA_MAX_LAG):
+                print(f"Read replica {url} {'available' if new is not None and new <= READ_REPLICA_MAX_LAG else 'skipped'}, lag {new}")
+        self.lags = lags
+
+    def refresh(self):
+        """Measure the lag of each replica, at most once per READ_REPLICA_CHECK_INTERVAL"""
+        if not self.due():
+            return
+
+        primary_versions = None
+        lags = []
+        for replica in self.replicas:
+            try:
+                with replica.connect() as conn:
+                    if replica.dialect.name == 'postgresql':
+                        lags.append(replay_lag(conn.execute(POSTGRES_LAG).scalar()))
+                        continue
+                    replica_versions = conn.execute(data_versions_statement()).all()
+                if primary_versions is None:
+                    with self.primary.connect() as conn:
+                        primary_versions = conn.execute(data_versions_statement()).all()
+                lags.append(versions_lag(replica_versions, primary_versions))
+            except Exception as e:
+                print(f"Read replica check failed: {e}")
+                lags.append(None)
+
+        self.record(lags)
+
+    async def async_refresh(self):
+        """refresh for a set of async engines"""
+        if not self.due():
+            return
+
+        primary_versions = None
+        lags = []
+        for replica in self.replicas:
+            try:
+                async with replica.connect() as conn:
+                    if replica.dialect.name == 'postgresql':
+                        lags.append(replay_lag((await conn.execute(POSTGRES_LAG)).scalar()))
+                        continue
+                    replica_versions = (await conn.execute(data_versions_statement())).all()
+                if primary_versions is None:
+                    async with self.primary.connect() as conn:
+                        primary_versions = (await conn.execute(data_versions_statement())).all()
+                lags.append(versions_lag(replica_versions, primary_versions))
+            except Exception as e:
+                print(f"Read replica check failed: {e}")
+                lags.append(None)
+
+        self.record(lags)
+
+    def choose(self):
+        """The next replica within READ_REPLICA_MAX_LAG, or the primary if there is none
+
+        Returns:
+            Engine | AsyncEngine: The engine to read from
+        """
+        usable = [r for r, lag in zip(self.replicas, self.lags) if lag is not None and lag <= READ_REPLICA_MAX_LAG]
+        if not usable:
+            return self.primary
+        return usable[next(self.turns) % len(usable)]
+
+    def urls(self) -> List[str]:
+        """Replica urls without passwords"""
+        return [r.url.render_as_string(hide_password=True) for r in self.replicas]
+
+    def status(self) -> List[dict]:
+        """Last measured lag of each replica, None if it could not be reached"""
+        return [{'url': url, 'lag_seconds': lag, 'in_use': lag is not None and lag <= READ_REPLICA_MAX_LAG}
+                for url, lag in zip(self.urls(), self.lags)]
@@ -1,5 +1,5 @@
-from typing import Optional, Dict, List, Tuple
-from typing_extensions import TypedDict
+from typing import Optional, Dict, List, Tuple, Union
+from typing_extensions import TypedDict, Literal
 from pydantic import BaseModel
 
 # study schemata
@@ -28,6 +28,23 @@ class Study(StudyBase):
     class Config:
         orm_mode = True
 
+class StudyFields(BaseModel):
+    # a page of search results holding only the requested fields
+    study_id: int
+    title: Optional[str]
+    description: Optional[str]
+    data_type: Optional[str]
+    submitted: Optional[str]
+    organism_name: Optional[str]
+    organism_id: Optional[int]
+    external_db: Optional[str]
+    external_db_id: Optional[str]
+    organization: Optional[str]
+    accession_number: Optional[str]
+    n_samples: Optional[int]
+    gds_type: Optional[str]
+    has_data: Optional[int]
+
 # sample schemata
 
 class SampleBase(BaseModel):
@@ -49,11 +66,28 @@ class Sample(SampleBase):
 # search schema
 
 class Search(BaseModel):
-    search_string: str
+    # every filter is optional -- omitted filters match all studies
+    search_string: str = ""
+    n_samples: Optional[int] = None
+    n_samples_max: Optional[int] = None
+    organism: Optional[Union[str, List[str]]] = None
+    profiling_method: Optional[Union[str, List[str]]] = None
+    has_data: Optional[int] = None
+
+class FacetCount(BaseModel):
+    value: Optional[Union[int, str]]
+    n_studies: int
     n_samples: int
-    organism: str
-    profiling_method: str
-    has_data: int
+
+class Facets(BaseModel):
+    organism: List[FacetCount]
+    profiling_method: List[FacetCount]
+    has_data: List[FacetCount]
+
+class Suggestion(BaseModel):
+    label: str
+    kind: Literal['term', 'organism']
+    n_studies: int
 
 # task status
 
@@ -61,6 +95,9 @@ class QueuedForUpload(BaseModel):
     task_id: str
     n_records: int
 
+class QueuedDownload(BaseModel):
+    task_id: str
+
 class Status(BaseModel):
     task_id: str
     task_status: str
@@ -86,6 +123,24 @@ class GeneExpression(GeneExpressionBase):
     class Config:
         orm_mode = True
 
+class ExpressionValue(BaseModel):
+    gene: str
+    sample_accession: str
+    value: Optional[float]
+
+# data query schemata
+
+class SampleFilter(BaseModel):
+    variable: str
+    op: Literal['eq', 'ne', 'in', 'contains'] = 'eq'
+    value: Union[str, List[str]]
+
+class DataQuery(BaseModel):
+    study_accessions: List[str]
+    genes: Optional[List[str]]
+    samples: Optional[List[str]]
+    sample_filters: Optional[List[SampleFilter]]
+
 class BioprojectQuery(BaseModel):
     entrez_email: str
     bioproject_query: str
@@ -0,0 +1,127 @@
+import bisect
+import heapq
+import re
+import threading
+
+from typing import Dict, List, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from . import cache, models
+
+# words of at least three characters, starting with a letter -- keeps gene symbols like tp53 and il-6
+TOKEN_PATTERN = re.compile(r"[a-z][a-z0-9\-]{2,}")
+
+STOPWORDS = {
+    'about', 'also', 'and', 'are', 'been', 'between', 'but', 'can', 'for', 'from', 'had', 'has',
+    'have', 'here', 'into', 'its', 'may', 'not', 'our', 'such', 'than', 'that', 'the', 'their',
+    'these', 'this', 'those', 'via', 'was', 'were', 'which', 'while', 'with', 'within',
+}
+
+# most prefixes whose suggestions are kept between data versions
+MAX_CACHED_PREFIXES = 10000
+
+# new studies read per query when the index is refreshed
+STUDY_BATCH_SIZE = 500
+
+TERM = 'term'
+ORGANISM = 'organism'
+
+
+def study_terms(title: str, description: str) -> set:
+    """Distinct vocabulary terms of a study's title and description"""
+    text = f"{title or ''} {description or ''}".lower()
+    return {t.strip('-') for t in TOKEN_PATTERN.findall(text)} - STOPWORDS
+
+
+class SuggestIndex:
+    """In-memory prefix index of study vocabulary and organism names for typeahead
+
+    Keys are kept in one sorted list, so a prefix is answered with two bisections and
+    a top-k over the matching range. The index follows the studies data version: new
+    studies are added incrementally, and it is rebuilt if studies were removed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.study_ids = frozenset()
+        # entries map (key, kind) -> [label, number of studies], keys are the sorted entries,
+        # results memoizes answered prefixes -- replaced together as one tuple
+        self.index: Tuple[Dict[Tuple[str, str], list], List[Tuple[str, str]], dict] = ({}, [], {})
+
+    def refresh(self, db: Session):
+        """Bring the index up to date with the studies table if its data version grew
+
+        Study IDs are BioProject UIDs, which are not assigned in load order, so new
+        studies are found by comparing the set of IDs rather than the largest one.
+
+        Args:
+            db (Session): A database session
+        """
+        # versions only grow -- an older one comes from a replica that has not caught up yet
+        version = cache.data_version(db, cache.STUDIES)
+        if self.version is not None and version <= self.version:
+            return
+
+        with self.lock:
+            if self.version is not None and version <= self.version:
+                return
+
+            study_ids = frozenset(r[0] for r in db.execute(select(models.Study.study_id)))
+
+            entries = {k: list(v) for k, v in self.index[0].items()}
+            new_ids = study_ids - self.study_ids
+            if not self.study_ids <= study_ids:
+                # studies were removed -- start over
+                entries, new_ids = {}, study_ids
+
+            new_ids = sorted(new_ids)
+            for i in range(0, len(new_ids), STUDY_BATCH_SIZE):
+                stmt = select(
+                    models.Study.title, models.Study.description, models.Study.organism_name
+                ).where(
+                    models.Study.study_id.in_(new_ids[i:i + STUDY_BATCH_SIZE])
+                )
+                for title, description, organism in db.execute(stmt):
+                    for term in study_terms(title, description):
+                        entries.setdefault((term, TERM), [term, 0])[1] += 1
+                    if organism:
+                        entries.setdefault((organism.lower(), ORGANISM), [organism, 0])[1] += 1
+
+            # swap in the new structures at once, so readers never see a partial index
+            self.index = (entries, sorted(entries), {})
+            self.version, self.study_ids = version, study_ids
+
+    def suggest(self, db: Session, prefix: str, limit: int = 10) -> List[dict]:
+        """Most common terms and organisms starting with prefix
+
+        Args:
+            db (Session): A database session
+            prefix (str): The text typed so far
+            limit (int, optional): Most suggestions returned. Defaults to 10.
+
+        Returns:
+            list[dict]: Suggestions with their label, kind and number of studies, most common first
+        """
+        self.refresh(db)
+
+        prefix = prefix.strip().lower()
+        if prefix == '':
+            return []
+
+        entries, keys, results = self.index
+
+        hit = results.get((prefix, limit))
+        if hit is not None:
+            return hit
+
+        start = bisect.bisect_left(keys, (prefix,))
+        end = bisect.bisect_left(keys, (prefix + '\uffff',), lo=start)
+        top = heapq.nlargest(limit, keys[start:end], key=lambda k: entries[k][1])
+
+        hit = [{'label': entries[k][0], 'kind': k[1], 'n_studies': entries[k][1]} for k in top]
+        if len(results) < MAX_CACHED_PREFIXES:
+            results[(prefix, limit)] = hit
+        return hit
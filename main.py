@@ -8,12 +8,10 @@ from fastapi.openapi.utils import get_openapi
 
 from celery.result import AsyncResult
 
-from db_utils import models, schemas
-from db_utils.database import engine
+from db_utils import schemas
 
 from routers import studies, data, admin
-
-models.Base.metadata.create_all(bind=engine)  # create all tables
+from routers.router_functions import NotModified, not_modified_handler
 
 app = FastAPI()
 
@@ -33,6 +31,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # paging and revalidation headers read by the frontend
+    expose_headers=["X-Next-Cursor", "X-Total-Count", "ETag"],
 )
 
 # custom openapi spec text
@@ -68,6 +68,9 @@ def validation_exception_handler(request: Request, exc: RequestValidationError):
     content = {'status_code': 10422, 'message': exc_str, 'data': None}
     return JSONResponse(content=content, status_code=status.HTTP_422_UNPROCESSABLE_ENTITY)
 
+# revalidated lookups -- an empty 304, see router_functions.conditional_request
+app.add_exception_handler(NotModified, not_modified_handler)
+
 # keeping this method around for later when we put an admin interface in front of this
 # will allow us to poll this endpoint for status of long-running tasks
 @app.get("/v1/tasks/{task_id}", response_model=schemas.Status)
@@ -11,9 +11,10 @@ from fastapi.responses import FileResponse, JSONResponse
 
 from sqlalchemy.orm import Session
 
-from db_utils.database import get_db
-from db_utils import schemas, models
+from db_utils.database import async_engine, async_read_replicas, engine, get_db, read_replicas
+from db_utils import schemas, models, pools
 from worker import *
+from routers.router_functions import conditional_request
 
 # %%
 
@@ -34,7 +35,7 @@ router = APIRouter(
 
 
 @router.get('/dataStructure', status_code=200, response_model=schemas.Admin)
-def get_data_structure(db: Session = Depends(get_db)):
+def get_data_structure(db: Session = Depends(get_db), cache_headers: dict = Depends(conditional_request)):
     # create a dictionary that conforms to the admin schema from schemas.py
     data_structure = {
         'study_metadata_table': {
@@ -77,13 +78,13 @@ def get_data_structure(db: Session = Depends(get_db)):
         },
         'shared_key': 'accession_number'
     }
-    return JSONResponse(data_structure, status_code=200)
+    return JSONResponse(data_structure, status_code=200, headers=cache_headers)
 
 # create a route that returns a InputCollection schema with two Test schema objects inside
 
 
 @router.get('/inputs', status_code=200, response_model=schemas.InputCollection)
-def get_test():
+def get_test(cache_headers: dict = Depends(conditional_request)):
     input_collection = {
         'inputs': [
             {
@@ -137,4 +138,33 @@ def get_test():
             }
         ]
     }
-    return JSONResponse(input_collection, status_code=200)
+    return JSONResponse(input_collection, status_code=200, headers=cache_headers)
+
+
+@router.get('/poolStats', status_code=200)
+def get_pool_stats():
+    """Report database connection pool use for the API and the Celery worker processes
+
+    Returns:\n
+        dict: Pool size, checked-out connections, overflow, checkouts and wait times per engine.
+        Read replicas also report their last measured replication lag.
+        Worker processes are keyed by host:pid, as of their last finished task.
+    """
+    try:
+        workers = worker_pool_stats()
+    except Exception as e:
+        workers = {'error': str(e)}
+
+    stats = {
+        'api': {
+            'pid': os.getpid(),
+            'sync': pools.pool_stats(engine),
+            'async': pools.pool_stats(async_engine.sync_engine),
+            'read_replicas': [
+                {**replica, 'sync': pools.pool_stats(sync), 'async': pools.pool_stats(asynchronous.sync_engine)}
+                for replica, sync, asynchronous in zip(read_replicas.status(), read_replicas.replicas, async_read_replicas.replicas)
+            ],
+        },
+        'workers': workers
+    }
+    return JSONResponse(stats, status_code=200)
@@ -1,23 +1,23 @@
 # %%
 import pandas as pd
-import tempfile
-import zipfile
 import boto3
 import os
 import re
 
 from dotenv import load_dotenv
 from datetime import datetime
-from typing import List
+from typing import List, Union
 
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, Request, status, UploadFile, File
+from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, StreamingResponse
 
 from sqlalchemy.orm import Session
 from sqlalchemy import insert
+from celery.result import AsyncResult
 
-from db_utils.database import get_db
-from db_utils import schemas, models
+from db_utils.database import get_read_db
+from db_utils import schemas, models, crud, archives
+from routers.router_functions import ranged_file_response
 from worker import *
 
 # %%
@@ -31,90 +31,149 @@ dotenv_path = os.path.join(
 load_dotenv(dotenv_path)
 
 
+archive_cache = archives.ArchiveCache()
+
+DOWNLOAD_HEADERS = {'Content-Disposition': 'attachment; filename="respire_data_download.zip"',
+                    'Accept': 'application/zip, application/octet-stream '}
+
 router = APIRouter(
     prefix="/v1/data",
     tags=['Data'],
-    dependencies=[Depends(get_db)]
+    dependencies=[Depends(get_read_db)]
 )
 
-@router.post("/download", response_class=FileResponse)
-def download_data_file(study_accessions: List[str], db: Session = Depends(get_db)):
+@router.post("/download", response_class=StreamingResponse)
+def download_data_file(request: Request,
+                       study_accessions: Union[List[str], schemas.DataQuery] = Body(...),
+                       mode: str = 'stream',
+                       format: str = 'csv',
+                       db: Session = Depends(get_read_db)):
     """Download selected studies
 
+    The archive is built while it is sent, one sample or gene row at a time,
+    so memory use does not depend on the number of studies selected. Finished
+    archives are cached on disk and repeat downloads support HTTP Range requests.
+
+    With mode=job the archive is built by a background task instead. Poll
+    /v1/tasks/{task_id} and fetch the result from /v1/data/download/{task_id}.
+
+    Besides CSV, the matrix and metadata can be written as parquet, feather or
+    hdf5 files with float32 expression columns.
+
+    The body is either a list of study IDs or a data query that also restricts
+    the genes, samples and sample metadata values to include.
+
     Args:\n
-        study_accessions (list[str]): A list of study IDs
-        db (Session, optional): Database session. Defaults to Depends(get_db).
+        study_accessions (list[str] | schemas.DataQuery): A list of study IDs, or a data query
+        mode (str, optional): 'stream' to return the archive, or 'job' to queue it. Defaults to 'stream'.
+        format (str, optional): 'csv', 'parquet', 'feather' or 'hdf5'. Defaults to 'csv'.
+        db (Session, optional): Database session. Defaults to Depends(get_read_db).
 
     Returns:\n
-        FileResponse: A ZIP file containing data for selected studies
+        StreamingResponse: A ZIP file containing data for selected studies, or the queued task ID
     """
-    # get metadata for all selected studies
-    metadta_query = db.query(
-        models.Sample.sample_accession,
-        models.Sample.variable,
-        models.Sample.value
-    ).filter(
-        models.Sample.accession_number.in_(study_accessions)
-    ).distinct()
-
-    # read into memory
-    res_df = pd.read_sql(
-        metadta_query.statement, db.bind
-    ).drop_duplicates(
-        ['sample_accession', 'variable']
-    ).pivot(
-        index='sample_accession', columns='variable', values='value'
-    ).reset_index()
+    if mode not in ('stream', 'job'):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown download mode '{mode}'")
+
+    try:
+        archives.check_format(format)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    if mode == 'job' and not (os.environ.get('DOWNLOAD_BUCKET') or archives.ARCHIVE_CACHE_SHARED):
+        # the worker's archive would be out of this server's reach
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Download jobs need DOWNLOAD_BUCKET or a shared ARCHIVE_CACHE_DIR, use mode=stream")
+
+    if isinstance(study_accessions, schemas.DataQuery):
+        query = study_accessions
+    else:
+        query = schemas.DataQuery(study_accessions=study_accessions)
+
+    # serve repeat downloads from the cache
+    key = archives.archive_key(db, query, format)
+    cached_fp = archive_cache.get(key)
+    if cached_fp is not None and mode == 'stream':
+        return ranged_file_response(request, cached_fp, headers=DOWNLOAD_HEADERS)
 
     # stop if empty
-    if res_df.shape[0] == 0:
+    if not crud.has_sample_metadata(db, query.study_accessions):
         raise HTTPException(
             status_code=404, detail="Studies specified do not have data available for download")
 
-    # read gene expression data
-    data_query = db.query(
-        models.GeneExpression.gene,
-        models.GeneExpression.sample_accession,
-        models.GeneExpression.value
-    ).filter(
-        models.GeneExpression.accession_number.in_(study_accessions)
-    ).distinct()
+    if mode == 'job':
+        task = build_download_archive.delay(query.dict(), format)
+        return JSONResponse({'task_id': task.id}, status_code=status.HTTP_202_ACCEPTED)
 
-    data_df = pd.read_sql(
-        data_query.statement, db.bind
-    ).pivot(
-        index='gene', columns='sample_accession', values='value'
-    ).reset_index()
+    # read the archive from the database the key was computed on
+    archive = archives.iter_download_archive(query, format, bind=db.get_bind())
+    return StreamingResponse(archive_cache.store(key, archive),
+                             media_type='application/zip',
+                             headers=DOWNLOAD_HEADERS)
 
-    outdir = os.path.join(tempfile.gettempdir(), 'respire_data_download')
 
-    if not os.path.exists(outdir):
-        os.mkdir(outdir)
+@router.get("/download/{task_id}", response_class=FileResponse)
+def fetch_download_job(task_id: str, request: Request):
+    """Fetch an archive built by a download job
 
-    zip_fp = os.path.join(outdir, 'respire_data_download.zip')
-    metadata_fp = os.path.join(outdir, "metadata.csv")
-    data_fp = os.path.join(outdir, "data_compendium.csv")
-    readme_fp = os.path.join(outdir, "readme.txt")
+    Args:\n
+        task_id (str): ID returned by /v1/data/download?mode=job
+
+    Returns:\n
+        FileResponse: The ZIP file, or a redirect to a presigned S3 link
+    """
+    task_result = AsyncResult(task_id)
+
+    if task_result.status != 'SUCCESS':
+        return JSONResponse({'task_id': task_id, 'task_status': task_result.status},
+                            status_code=status.HTTP_409_CONFLICT)
+
+    result = task_result.result
 
-    res_df.to_csv(metadata_fp, index=False)
-    data_df.to_csv(data_fp, index=False)
+    if 's3_key' in result:
+        url = get_s3_client().generate_presigned_url(
+            'get_object',
+            Params={'Bucket': os.environ.get('DOWNLOAD_BUCKET'), 'Key': result['s3_key']},
+            ExpiresIn=int(os.environ.get('DOWNLOAD_URL_EXPIRES') or 3600)
+        )
+        return RedirectResponse(url)
 
-    archive_time = datetime.now()
+    archive_fp = archive_cache.get(result['key'])
+    if archive_fp is None:
+        raise HTTPException(
+            status_code=status.HTTP_410_GONE, detail="Archive has expired, start a new download")
+
+    # fetched -- from now on it is evicted like any other cached archive
+    archive_cache.unpin(result['key'])
+
+    return ranged_file_response(request, archive_fp, headers=DOWNLOAD_HEADERS)
 
-    with open(readme_fp, 'wt') as f:
-        f.writelines(line + "\n" for line in [f"Downloaded on {archive_time.strftime('%m-%d-%Y at %H:%M:%S')}",
-                                              "Metadata sourced from NCBI databases including BioProject and the Gene Expression Omnibus",
-                                              "Includes data from the following studies:", "  " + "\n  ".join(study_accessions)])
 
-    file_list = [metadata_fp, data_fp, readme_fp]
+@router.post("/query", response_model=List[schemas.ExpressionValue])
+def query_data(query: schemas.DataQuery,
+               limit: int = Query(10000, ge=1, le=100000),
+               db: Session = Depends(get_read_db)):
+    """Query gene expression values in long format
 
-    with zipfile.ZipFile(zip_fp, 'w') as zip:
-        for file in file_list:
-            zip.write(file,
-                      compress_type=zipfile.ZIP_DEFLATED,
-                      arcname=f"respire_data_download_{archive_time.strftime('%Y%m%d_%H_%M_%S')}/{os.path.basename(file)}")
+    Gene, sample and sample metadata filters are applied in the database, so the
+    work done is proportional to the selection rather than the size of the studies.
 
-    headers = {'Content-Disposition': 'attachment; filename="respire_data_download.zip"',
-               'Accept': 'application/zip, application/octet-stream '}
+    Args:\n
+        query (schemas.DataQuery): Selected studies, genes, samples and sample filters
+        limit (int, optional): Maximum number of values to return. Defaults to 10000.
+        db (Session, optional): Database session. Defaults to Depends(get_read_db).
 
-    return FileResponse(zip_fp, headers=headers)
+    Returns:\n
+        list[schemas.ExpressionValue]: Gene, sample and value for each selected measurement
+    """
+    rows = crud.expression_query(db,
+                                 query.study_accessions,
+                                 ordered=True,
+                                 genes=query.genes,
+                                 samples=query.samples,
+                                 sample_filters=query.sample_filters).limit(limit)
+
+    return [{'gene': gene, 'sample_accession': sample_accession, 'value': archives.to_float(value)}
+            for gene, sample_accession, value in rows]
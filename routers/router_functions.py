@@ -1,3 +1,20 @@
+import base64
+import hashlib
+import json
+import os
+import re
+
+from fastapi import Depends, Request, status
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db_utils import cache
+from db_utils.database import get_async_read_db
+
+# seconds clients may reuse a lookup response before revalidating it
+CACHE_MAX_AGE = int(os.environ.get('CACHE_MAX_AGE') or 60)
+
+
 def lazy_file_reader(file_object, chunk_size=1024):
     """Lazy function (generator) to read a file piece by piece.
     Default chunk size: 1k."""
@@ -6,3 +23,127 @@ def lazy_file_reader(file_object, chunk_size=1024):
         if not data:
             break
         yield data
+
+
+def read_file_range(path, start, length, chunk_size=1024 * 1024):
+    """Lazy function (generator) to read length bytes of a file from start."""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        for data in lazy_file_reader(f, chunk_size):
+            data = data[:length]
+            length -= len(data)
+            yield data
+            if length <= 0:
+                break
+
+
+def ranged_file_response(request, path, headers=None, media_type='application/zip'):
+    """Serve a file, honouring a single-range HTTP Range header
+
+    Args:
+        request (Request): The incoming request
+        path (str): File to serve
+        headers (dict, optional): Extra response headers. Defaults to None.
+        media_type (str, optional): Content type. Defaults to 'application/zip'.
+
+    Returns:
+        Response: 200 with the whole file, 206 with the requested range, or 416
+    """
+    headers = dict(headers or {})
+    headers['Accept-Ranges'] = 'bytes'
+
+    size = os.path.getsize(path)
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", request.headers.get('range', '').strip())
+
+    if match is None or match.groups() == ('', ''):
+        return FileResponse(path, headers=headers, media_type=media_type)
+
+    first, last = match.groups()
+    if first == '':
+        # suffix range -- the last n bytes
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last != '' else size - 1
+
+    if start >= size or start > end:
+        return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                        headers={'Content-Range': f"bytes */{size}"})
+
+    headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+    headers['Content-Length'] = str(end - start + 1)
+
+    return StreamingResponse(read_file_range(path, start, end - start + 1),
+                             status_code=status.HTTP_206_PARTIAL_CONTENT,
+                             headers=headers,
+                             media_type=media_type)
+
+
+def encode_cursor(cursor):
+    """Encode a (relevance, study_id) keyset as an opaque page cursor"""
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decode a page cursor made by encode_cursor -- raises ValueError if it is malformed"""
+    try:
+        rank, study_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return (None if rank is None else float(rank)), int(study_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def etag_matches(etag, if_none_match):
+    """Check an If-None-Match header against an ETag"""
+    tags = [t.strip() for t in if_none_match.split(',')]
+    return '*' in tags or etag in tags or f"W/{etag}" in tags
+
+
+class NotModified(Exception):
+    """Raised by conditional_request when the client's copy is current, see not_modified_handler"""
+
+    def __init__(self, headers: dict):
+        self.headers = headers
+
+
+def not_modified_handler(request: Request, exc: NotModified):
+    """Answer a revalidation with an empty 304 -- HTTPException responses carry a JSON body"""
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=exc.headers)
+
+
+async def conditional_request(request: Request, response: Response, db: AsyncSession = Depends(get_async_read_db)):
+    """Dependency answering revalidations of responses that only change when data is ingested
+
+    The ETag hashes the study and sample data versions with the request URL. A matching
+    If-None-Match header gets a 304 before the endpoint runs, so no lookup query is made.
+    Data versions are read from the database at most once per DATA_VERSION_TTL. Only GET
+    and HEAD requests are tagged and cached -- other methods get no cache headers.
+
+    Args:
+        request (Request): The incoming request
+        response (Response): The response of endpoints that return plain values
+        db (AsyncSession, optional): An async database session. Defaults to Depends(get_async_read_db).
+
+    Raises:
+        NotModified: When the client's copy is current
+
+    Returns:
+        dict: ETag and Cache-Control headers, for endpoints that build their own response
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return {}
+
+    versions = [await cache.async_data_version(db, scope) for scope in (cache.STUDIES, cache.SAMPLES)]
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps([versions, str(request.url.path), str(request.url.query)]).encode())
+
+    headers = {
+        'ETag': f'"{digest.hexdigest()[:32]}"',
+        'Cache-Control': f"public, max-age={CACHE_MAX_AGE}",
+    }
+
+    if etag_matches(headers['ETag'], request.headers.get('if-none-match', '')):
+        raise NotModified(headers)
+
+    response.headers.update(headers)
+    return headers
@@ -1,83 +1,182 @@
-from fastapi import APIRouter, Depends
-from typing import List
-from db_utils.database import get_db
-from db_utils import schemas, crud
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, status
+from fastapi.responses import JSONResponse
+from typing import Dict, List, Optional
+from db_utils.database import get_async_read_db, get_read_db
+from db_utils import schemas, async_crud, suggest
+from routers.router_functions import conditional_request, decode_cursor, encode_cursor
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 router = APIRouter(
     prefix="/v1/studies",
     tags=['Studies'],
-    dependencies=[Depends(get_db)]
+    dependencies=[Depends(conditional_request)]
 )
 
+suggest_index = suggest.SuggestIndex()
+
+
+def parse_fields(fields: Optional[str]):
+    """Split a comma-separated fields parameter, rejecting names that are not study fields"""
+    if not fields:
+        return None
+
+    field_list = [f.strip() for f in fields.split(',') if f.strip()]
+    unknown = set(field_list) - set(schemas.StudyBase.__fields__)
+    if unknown:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    return field_list
+
 @router.post("/organisms", response_model=List[str])
-def get_organisms(has_data: int, db: Session = Depends(get_db)):
+async def get_organisms(has_data: int, db: AsyncSession = Depends(get_async_read_db)):
     """Retrieve list of all organisms in the database
 
     Args:\n
-        db (Session, optional): A database session. Defaults to Depends(get_db).
+        db (AsyncSession, optional): An async database session. Defaults to Depends(get_async_read_db).
 
     Returns:\n
         list[str]: A list of organism names
     """
 
-    return crud.list_organisms(db=db, has_data=has_data)
+    return await async_crud.list_organisms(db=db, has_data=has_data)
 
 @router.get("/naiveOrganisms", response_model=List[str])
-def get_organisms(db: Session = Depends(get_db)):
+async def get_organisms(db: AsyncSession = Depends(get_async_read_db)):
     """Retrieve list of all organisms in the database
 
     Args:\n
-        db (Session, optional): A database session. Defaults to Depends(get_db).
+        db (AsyncSession, optional): An async database session. Defaults to Depends(get_async_read_db).
 
     Returns:\n
         list[str]: A list of organism names
     """
 
-    return crud.list_organisms(db=db, has_data=1)
+    return await async_crud.list_organisms(db=db, has_data=1)
 
 @router.post("/profilingMethod", response_model=List[str])
-def get_profiling_methods(has_data: int, db: Session = Depends(get_db)):
+async def get_profiling_methods(has_data: int, db: AsyncSession = Depends(get_async_read_db)):
     """Retrieve list of all profiling methods
 
     Args:\n
-        db (Session, optional): A database session. Defaults to Depends(get_db).
+        db (AsyncSession, optional): An async database session. Defaults to Depends(get_async_read_db).
 
     Returns:\n
         list[str]: A list of profiling methods
     """
 
-    return crud.list_profiling_methods(db=db, has_data=has_data)
+    return await async_crud.list_profiling_methods(db=db, has_data=has_data)
 
 @router.get("/naiveProfilingMethod", response_model=List[str])
-def get_profiling_methods(db: Session = Depends(get_db)):
+async def get_profiling_methods(db: AsyncSession = Depends(get_async_read_db)):
     """Retrieve list of all profiling methods
 
     Args:\n
-        db (Session, optional): A database session. Defaults to Depends(get_db).
+        db (AsyncSession, optional): An async database session. Defaults to Depends(get_async_read_db).
 
     Returns:\n
         list[str]: A list of profiling methods
     """
 
-    return crud.list_profiling_methods(db=db, has_data=1)
+    return await async_crud.list_profiling_methods(db=db, has_data=1)
 
 
-@router.post("/searchMetadata", response_model=List[schemas.Study])
-def find_studies(Search: schemas.Search, db: Session = Depends(get_db)):
+@router.get("/suggest", response_model=List[schemas.Suggestion])
+def get_suggestions(q: str, limit: int = Query(10, ge=1, le=50), db: Session = Depends(get_read_db)):
+    """Suggest search terms and organisms starting with the text typed so far
+
+    Args:\n
+        q (str): The text typed so far\n
+        limit (int, optional): Most suggestions returned. Defaults to 10.\n
+        db (Session, optional): A database session. Defaults to Depends(get_read_db).
+
+    Returns:\n
+        list[schemas.Suggestion]: Terms and organisms found in the most studies first
+    """
+    return suggest_index.suggest(db, q, limit)
+
+
+@router.post("/facets", response_model=schemas.Facets)
+async def get_facets(Search: schemas.Search, db: AsyncSession = Depends(get_async_read_db)):
+    """Count matching studies and samples per organism, profiling method and has_data value
+
+    Args:\n
+        Search (schemas.Search): A valid search object\n
+        db (AsyncSession, optional): An async database session. Defaults to Depends(get_async_read_db).
+
+    Returns:\n
+        schemas.Facets: Study and sample counts for each value of each facet, largest first
+    """
+    return await async_crud.count_facets(db=db, search=Search)
+
+
+@router.post("/searchMetadata", response_model=List[schemas.StudyFields])
+async def find_studies(Search: schemas.Search,
+                 limit: Optional[int] = Query(None, ge=1, le=1000),
+                 cursor: Optional[str] = None,
+                 fields: Optional[str] = None,
+                 include_total: bool = False,
+                 db: AsyncSession = Depends(get_async_read_db),
+                 cache_headers: dict = Depends(conditional_request)):
     """Search project metadata for results
 
     Args:\n
         Search (schemas.Search): A valid search object\n
-        db (Session, optional): A database session. Defaults to Depends(get_db).
+        limit (int, optional): Page size. Defaults to None, which returns every match.\n
+        cursor (str, optional): The X-Next-Cursor header of the previous page. Defaults to None.\n
+        fields (str, optional): Comma-separated study fields to return; study_id is always included. Defaults to None, all fields.\n
+        include_total (bool, optional): Count all matches into the X-Total-Count header. Defaults to False.\n
+        db (AsyncSession, optional): An async database session. Defaults to Depends(get_async_read_db).\n
+        cache_headers (dict, optional): ETag and Cache-Control headers. Defaults to Depends(conditional_request).
 
     Returns:\n
-        list[schemas.Study]: List of studies
+        list[schemas.StudyFields]: List of studies, most relevant first
     """
-    return crud.search_studies(db=db,
-                               search_string=Search.search_string,
-                               organism=Search.organism,
-                               n_samples=Search.n_samples,
-                               profiling_method=Search.profiling_method,
-                               has_data=Search.has_data
-                               )
+    field_list = parse_fields(fields)
+
+    try:
+        page_cursor = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    page = await async_crud.search_studies_page(db=db,
+                                    search=Search,
+                                    fields=field_list,
+                                    limit=limit,
+                                    cursor=page_cursor,
+                                    include_total=include_total)
+
+    # rows are plain dicts of json types, so skip response model validation
+    headers = dict(cache_headers)
+    if page['next_cursor'] is not None:
+        headers['X-Next-Cursor'] = encode_cursor(page['next_cursor'])
+    if page['total'] is not None:
+        headers['X-Total-Count'] = str(page['total'])
+
+    return JSONResponse(page['results'], headers=headers)
+
+
+@router.post("/searchMetadata/batch", response_model=Dict[int, List[schemas.StudyFields]])
+async def find_studies_batch(Searches: List[schemas.Search] = Body(..., min_items=1, max_items=50),
+                       limit: Optional[int] = Query(None, ge=1, le=1000),
+                       fields: Optional[str] = None,
+                       db: AsyncSession = Depends(get_async_read_db),
+                       cache_headers: dict = Depends(conditional_request)):
+    """Run several searches at once, in a single query
+
+    Args:\n
+        Searches (list[schemas.Search]): Up to 50 valid search objects\n
+        limit (int, optional): Most results returned per search. Defaults to None, every match.\n
+        fields (str, optional): Comma-separated study fields to return; study_id is always included. Defaults to None, all fields.\n
+        db (AsyncSession, optional): An async database session. Defaults to Depends(get_async_read_db).\n
+        cache_headers (dict, optional): ETag and Cache-Control headers. Defaults to Depends(conditional_request).
+
+    Returns:\n
+        dict[int, list[schemas.StudyFields]]: The studies matching each search, keyed by its position in the request
+    """
+    results = await async_crud.search_studies_batch(db=db,
+                                        searches=Searches,
+                                        fields=parse_fields(fields),
+                                        limit=limit)
+
+    return JSONResponse({str(i): studies for i, studies in results.items()}, headers=cache_headers)
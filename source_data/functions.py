@@ -86,6 +86,63 @@ def get_links(study_id: str, db_from: str = 'bioproject', db_to: str = 'biosampl
     return ET.XML(res)
 
 
+def get_link_sets(study_ids: list, db_from: str = 'bioproject', db_to: str = 'biosample') -> dict:
+    """Link many NCBI IDs from one NCBI database to another in one request
+
+    Each ID is sent as its own `id` parameter, so elink returns one link set per ID
+    instead of mixing all linked IDs together. Long requests are sent as a POST.
+
+    Args:
+        study_ids (list): The study IDs for which to retrieve links
+        db_from (str, optional): The database containing the study IDs. Defaults to 'bioproject'.
+        db_to (str, optional): The linked database of interest. Defaults to 'biosample'.
+
+    Returns:
+        dict: The linked IDs of each study ID, in the order returned. IDs without links are omitted.
+    """
+
+    hndl = elink(db=db_to, dbfrom=db_from, id=[str(i) for i in study_ids])
+    res = hndl.read()
+    hndl.close()
+
+    parsed = xmltodict.parse(res, force_list=('LinkSet', 'LinkSetDb', 'Link'))
+
+    links = {}
+    for link_set in parsed['eLinkResult'].get('LinkSet') or []:
+        if not link_set.get('IdList'):
+            continue
+        links[link_set['IdList']['Id']] = [
+            link['Id']
+            for link_set_db in link_set.get('LinkSetDb') or [] if link_set_db['DbTo'] == db_to
+            for link in link_set_db.get('Link') or []
+        ]
+
+    return links
+
+
+def get_ncbi_summaries(study_ids: list, db: str = 'bioproject') -> dict:
+    """Retrieve the summaries of many studies in one request
+
+    Args:
+        study_ids (list): Valid study ID numbers
+        db (str, optional): Database to search for summaries. Defaults to 'bioproject'.
+
+    Returns:
+        dict: The top level summary items of each study ID, as a dict of item name to text
+    """
+
+    handl = esummary(db=db, id=[str(i) for i in study_ids])
+    res = handl.read()
+    handl.close()
+
+    parsed = xmltodict.parse(res, force_list=('DocSum', 'Item'))
+
+    return {
+        doc['Id']: {item['@Name']: item.get('#text') for item in doc.get('Item') or []}
+        for doc in parsed['eSummaryResult'].get('DocSum') or []
+    }
+
+
 def fetch_ncbi(study_id, db='bioproject', out='dict'):
     handl = efetch(db=db, id=study_id)
     res = handl.read()
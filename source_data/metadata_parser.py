@@ -4,14 +4,29 @@ from Bio.Entrez import esearch, efetch
 import xml.etree.ElementTree as ET
 import pandas as pd
 from retry import retry
-from .functions import extract_var, get_links, extract_keys, get_ncbi_summary
+from .functions import extract_var, get_link_sets, get_ncbi_summaries
 from .bioproject_struct import bioproject_struct
 
-# from functions import extract_var, get_links, extract_keys, get_ncbi_summary
+# from functions import extract_var, get_link_sets, get_ncbi_summaries
 # from bioproject_struct import bioproject_struct
 
 # %%
 
+# BioProject IDs per elink request -- each gets its own link set
+LINK_BATCH_SIZE = 200
+
+# GDS IDs per esummary request
+SUMMARY_BATCH_SIZE = 500
+
+# esummary items kept for each study, and their column names
+SUMMARY_FIELDS = {
+    'Accession': 'accession_number',
+    'entryType': 'entry_type',
+    'gdsType': 'gds_type',
+    'n_samples': 'n_samples',
+    'taxon': 'species',
+}
+
 
 class MetadataParser:
 
@@ -64,117 +79,46 @@ class MetadataParser:
         return self
 
     def link_bioproject_studies(self):
-        # sample_metadata = []
-        study_samples_meta = []
-        failed_studies = []
-
-        for bioproject_id in self.study_metadata.study_id:
-            print(f'Attempting link for UID {bioproject_id}')
+        """Link each BioProject to its GEO DataSet and add the DataSet summary
+
+        BioProject IDs are linked to GDS IDs with batched elink requests, and the
+        linked DataSets are summarized with batched esummary requests. Results are
+        joined back to study_id in memory. A failed batch is retried, then its
+        studies are recorded in failed_studies.
+        """
+        study_ids = [str(i) for i in self.study_metadata.study_id]
+
+        # link bioproject IDs to GEO data system IDs
+        study_gds = {}
+        for batch in batches(study_ids, LINK_BATCH_SIZE):
+            print(f'Attempting link for {len(batch)} UIDs')
+            try:
+                study_gds.update(link_gds_ids(batch))
+            except Exception as e:
+                print(f'Link failed for {len(batch)} UIDs: {e}')
+
+        # summarize each linked data set once
+        self.gds_ids = list(dict.fromkeys(study_gds.values()))
+        summaries = {}
+        for batch in batches(self.gds_ids, SUMMARY_BATCH_SIZE):
             try:
-                # # link bioporject IDs to GEO data system IDs
-                # links = get_links(str(bioproject_id), db_to='gds')
-
-                # # get ID values from results
-                # gds_ids = [study_id for study_id in extract_keys(
-                #     links, 'Id') if study_id != str(bioproject_id)]
-                # # print(gds_ids)
-
-                # # get summary and return as dict
-                # # TODO: investigate -- is this always the first element (0)?
-                # # I think this is correct, but hard indexing makes me nervous.
-                # gds_summary_dict = get_ncbi_summary(gds_ids[0], 'gds')
-
-                # # convert to DataFrame -- need to go in two levels for the needed info
-                # gds_summary_df = pd.DataFrame(
-                #     gds_summary_dict['eSummaryResult']['DocSum']['Item']
-                # )
-                # # clean up names
-                # gds_summary_df.rename(
-                #     columns={
-                #         '@Name': 'name',
-                #         '@Type': 'type',
-                #         '#text': 'text',
-                #         'Item': 'item'
-                #     },
-                #     inplace=True,
-                # )
-
-                # # filter for useful information in the name column
-                # data_summary = gds_summary_df.loc[
-                #     gds_summary_df.name.isin(
-                #         ['Accession', 'taxon', 'entryType', 'gdsType', 'n_samples']
-                #     )
-                # ][['name', 'text']].reset_index()
-
-                # # add bioproject ID for linking
-                # data_summary['study_id'] = int(bioproject_id)
-
-                # # pivot data to single record
-                # data_summary = data_summary.set_index(
-                #     'study_id'
-                # ).pivot(
-                #     columns='name', values='text'
-                # ).reset_index()
-
-                # # clean up names
-                # data_summary.rename(
-                #     columns={
-                #         'Accession': 'accession_number',
-                #         'entryType': 'entry_type',
-                #         'gdsType': 'gds_type',
-                #         'taxon': 'species'
-                #     },
-                #     inplace=True
-                # )
-                # # add gds ID for reference later
-                # data_summary['gds_id'] = gds_ids[0]
-
-                # # extract samples
-                # sample_list = list(gds_summary_df.loc[
-                #     # filter for samples, then extract the object stored in that row
-                #     gds_summary_df.name == 'Samples'
-                # ][['item']].iloc[0:].item)[0]
-
-                # samples = pd.concat([pd.DataFrame(i['Item']) for i in sample_list])
-
-                # # need to have an index that goes 1, 1, 2, 2, 3, 3, etc.
-                # # constructing list for that purpose
-                # idxlst = []
-                # for i in range(len(sample_list)):
-                #     idxlst.append(i)
-                #     idxlst.append(i)
-
-                # # create ID col as index
-                # samples['id'] = idxlst
-
-                # sample_ids = samples.set_index(
-                #     'id'
-                # ).pivot(
-                #     columns='@Name', values='#text'
-                # ).reset_index(
-                # )[['Accession', 'Title']]
-
-                # # add study id for linking
-                # sample_ids['study_id'] = int(bioproject_id)
-
-                # # clean up names
-                # sample_ids.rename(
-                #     columns={
-                #         'Title': 'sample_title',
-                #         'Accession': 'sample_accession'
-                #     },
-                #     inplace=True
-                # )
-
-                study_samples_meta.append(
-                    source_links(bioproject_id)
-                )
-
-            except:
-                failed_studies.append(bioproject_id)
-                print(f'Data load failed for ID {bioproject_id}')
-
-        self.summary_metadata = pd.concat(study_samples_meta).astype('str')
+                summaries.update(summarize_gds(batch))
+            except Exception as e:
+                print(f'Summary failed for {len(batch)} GDS IDs: {e}')
+
+        self.failed_studies = [i for i in study_ids if study_gds.get(i) not in summaries]
+        for study_id in self.failed_studies:
+            print(f'Data load failed for ID {study_id}')
+
+        rows = [
+            {'study_id': study_id,
+             **{column: summaries[gds_id].get(name) for name, column in SUMMARY_FIELDS.items()},
+             'gds_id': gds_id}
+            for study_id, gds_id in study_gds.items() if gds_id in summaries
+        ]
+        self.summary_metadata = pd.DataFrame(
+            rows, columns=['study_id', *SUMMARY_FIELDS.values(), 'gds_id']
+        ).astype('str')
 
         return self
         
@@ -191,65 +135,22 @@ class MetadataParser:
 # %%
 
 
-@retry(tries=3, delay=2, backoff=2)
-def source_links(bioproject_id):
-    # link bioporject IDs to GEO data system IDs
-    links = get_links(str(bioproject_id), db_to='gds')
+def batches(ids, size):
+    """Split a list of IDs into lists of at most size IDs"""
+    return [ids[i:i + size] for i in range(0, len(ids), size)]
 
-    # get ID values from results
-    gds_ids = [study_id for study_id in extract_keys(
-        links, 'Id') if study_id != str(bioproject_id)]
-    # print(gds_ids)
 
-    # get summary and return as dict
+@retry(tries=3, delay=2, backoff=2)
+def link_gds_ids(bioproject_ids):
+    """First GEO data system ID linked to each BioProject ID, in one elink request"""
+    links = get_link_sets(bioproject_ids, db_to='gds')
+
     # TODO: investigate -- is this always the first element (0)?
     # I think this is correct, but hard indexing makes me nervous.
-    gds_summary_dict = get_ncbi_summary(gds_ids[0], 'gds')
-
-    # convert to DataFrame -- need to go in two levels for the needed info
-    gds_summary_df = pd.DataFrame(
-        gds_summary_dict['eSummaryResult']['DocSum']['Item']
-    )
-    # clean up names
-    gds_summary_df.rename(
-        columns={
-            '@Name': 'name',
-            '@Type': 'type',
-            '#text': 'text',
-            'Item': 'item'
-        },
-        inplace=True,
-    )
-
-    # filter for useful information in the name column
-    data_summary = gds_summary_df.loc[
-        gds_summary_df.name.isin(
-            ['Accession', 'taxon', 'entryType', 'gdsType', 'n_samples']
-        )
-    ][['name', 'text']].reset_index()
-
-    # add bioproject ID for linking
-    data_summary['study_id'] = int(bioproject_id)
-
-    # pivot data to single record
-    data_summary = data_summary.set_index(
-        'study_id'
-    ).pivot(
-        columns='name', values='text'
-    ).reset_index()
-
-    # clean up names
-    data_summary.rename(
-        columns={
-            'Accession': 'accession_number',
-            'entryType': 'entry_type',
-            'gdsType': 'gds_type',
-            'taxon': 'species'
-        },
-        inplace=True
-    )
-    # add gds ID for reference later
-    data_summary['gds_id'] = gds_ids[0]
-
-    return data_summary
-# %%
+    return {bioproject_id: gds_ids[0] for bioproject_id, gds_ids in links.items() if gds_ids}
+
+
+@retry(tries=3, delay=2, backoff=2)
+def summarize_gds(gds_ids):
+    """Summary items of GEO data system IDs, in one esummary request"""
+    return get_ncbi_summaries(gds_ids, 'gds')
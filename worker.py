@@ -1,22 +1,27 @@
 # %%
-from db_utils import models
-from db_utils.database import SessionLocal
+from db_utils import models, schemas, loaders, archives, cache, migrations, pools
+from db_utils import database
 
 from source_data.metadata_parser import MetadataParser
 from source_data.functions import get_sample_metadata
 
 from fastapi import status
 from fastapi.responses import JSONResponse
-from sqlalchemy import insert, select, create_engine
+from sqlalchemy import insert, select
+from sqlalchemy.orm import sessionmaker
 
 from os.path import join, dirname
 from dotenv import load_dotenv
-from celery import Celery, Task
-from io import StringIO, TextIOWrapper
+from celery import Celery, Task, chord, group
+from celery.signals import task_postrun, worker_process_init
+from concurrent.futures import ProcessPoolExecutor
 
 import os
+import json
+import socket
+import time
+import uuid
 import boto3
-import csv
 
 # %%
 dotenv_path = join(dirname(__file__), 'db_utils', '.env')
@@ -26,6 +31,58 @@ load_dotenv(dotenv_path)
 # HELPERS
 #########################
 
+# one pooled engine per worker process, created by init_worker_engine
+
+process_engine = None
+
+WorkerSession = sessionmaker(autocommit=False, autoflush=False)
+
+# seconds a worker process's published pool statistics are kept
+POOL_STATS_TTL = 300
+
+
+def get_engine():
+    """The pooled engine of this process, created on first use outside a Celery worker process"""
+    global process_engine
+    if process_engine is None:
+        process_engine = pools.create_pooled_engine()
+    return process_engine
+
+
+@worker_process_init.connect
+def init_worker_engine(**kwargs):
+    """Give each forked worker process its own engine, and drop connections inherited from the parent"""
+    global process_engine
+    for inherited in (database.engine, process_engine):
+        if inherited is not None:
+            # close=False leaves the parent's connections open for the parent
+            inherited.dispose(close=False)
+    process_engine = pools.create_pooled_engine()
+
+
+@task_postrun.connect
+def publish_pool_stats(**kwargs):
+    """Store this process's pool statistics in the result backend, for /v1/admin/poolStats"""
+    if process_engine is None:
+        return
+    try:
+        key = f"pool_stats:{socket.gethostname()}:{os.getpid()}"
+        celery.backend.client.setex(key, POOL_STATS_TTL, json.dumps(pools.pool_stats(process_engine)))
+    except Exception as e:
+        print(f"Could not publish pool statistics: {e}")
+
+
+def worker_pool_stats():
+    """Pool statistics published by the worker processes, keyed by host:pid"""
+    client = celery.backend.client
+    stats = {}
+    for key in client.scan_iter("pool_stats:*"):
+        value = client.get(key)
+        if value is not None:
+            stats[key.decode().split(':', 1)[1]] = json.loads(value)
+    return stats
+
+
 # create a task with a database session available
 
 
@@ -35,14 +92,57 @@ class DatabaseTask(Task):
     def after_return(self, *args, **kwargs):
         if self._db is not None:
             self._db.close()
+            self._db = None
 
     @property
     def db(self):
         if self._db is None:
-            self._db = SessionLocal()
+            self._db = WorkerSession(bind=get_engine())
         return self._db
 
 
+def get_s3_client():
+    """Create an S3 client from the credentials in the environment"""
+    return boto3.client("s3",
+                        region_name='us-east-2',
+                        aws_access_key_id=os.environ.get(
+                            "AWS_ACCESS_KEY_ID"),
+                        aws_secret_access_key=os.environ.get(
+                            "AWS_SECRET_ACCESS_KEY")
+                        )
+
+
+def load_expression_range(aws_file_name: str, staging: str, start: int, end: int, columns: list, method: str = 'copy'):
+    """Load the lines that begin inside one byte range of an S3 object into a staging table
+
+    Args:
+        aws_file_name (str): Key of a CSV file in AWS_BUCKET
+        staging (str): Table to load into, from loaders.create_staging_table
+        start (int): First byte of the range
+        end (int): End of the range, exclusive
+        columns (list): Column names in file order
+        method (str, optional): 'copy' or 'executemany'. Defaults to 'copy'.
+
+    Returns:
+        dict: Load statistics for the range
+    """
+    engine = get_engine()
+
+    # start one byte early so the loader can tell whether the range begins on a new line
+    response = get_s3_client().get_object(
+        Bucket=os.environ.get('AWS_BUCKET'), Key=aws_file_name, Range=f"bytes={start - 1}-")
+
+    try:
+        return loaders.load_chunks(engine,
+                                   loaders.iter_range_chunks(response['Body'], start, end),
+                                   columns,
+                                   method=method,
+                                   table=staging,
+                                   log=None)
+    finally:
+        response['Body'].close()
+
+
 #########################
 # celery config
 #########################
@@ -64,59 +164,324 @@ celery.conf.result_backend = celery_result_backend
 
 
 @celery.task(base=DatabaseTask, bind=True, name="add_gene_expression_data")
-def ingest_gene_expression_data(self, aws_file_name: str):
+def ingest_gene_expression_data(self, aws_file_name: str, method: str = 'copy', upsert: bool = True, restart: bool = False):
+    """Load a gene expression file from S3
+
+    Progress is checkpointed per file after every committed block. Re-running the task
+    for a file that failed part way resumes from the last checkpoint with a ranged GET.
+
+    Args:
+        aws_file_name (str): Key of a CSV file in AWS_BUCKET
+        method (str, optional): 'copy' for PostgreSQL COPY (falls back to 'executemany' on other engines) or 'executemany'. Defaults to 'copy'.
+        upsert (bool, optional): Overwrite rows that already exist instead of failing on the primary key. Defaults to True.
+        restart (bool, optional): Ignore any saved checkpoint and load the whole file. Defaults to False.
+
+    Returns:
+        dict: Task status and load statistics
+    """
+
+    engine = get_engine()
+
+    checkpoint = loaders.start_checkpoint(engine, aws_file_name, restart=restart)
+
+    if checkpoint['completed'] == 1:
+        print(f"{aws_file_name} was already loaded, pass restart=True to load it again")
+        return {'status': True, **loaders.load_stats(0, 0)}
 
     # create a client
-    s3_client = boto3.client("s3",
-                             region_name='us-east-2',
-                             aws_access_key_id=os.environ.get(
-                                 "AWS_ACCESS_KEY_ID"),
-                             aws_secret_access_key=os.environ.get(
-                                 "AWS_SECRET_ACCESS_KEY")
-                             )
-    # get a file response
-    response = s3_client.get_object(
-        Bucket=os.environ.get('AWS_BUCKET'), Key=aws_file_name)
-
-    engine = create_engine(os.environ.get('SQLALCHEMY_DATABASE_URL'))
-
-    # number of records to process at a time
-    batch_size = 250000
-
-    csv_reader = csv.DictReader(
-        TextIOWrapper(
-            response['Body'], encoding='utf-8'
-        )
-    )
+    s3_client = get_s3_client()
+    bucket = os.environ.get('AWS_BUCKET')
 
-    batch = []
-    for i, row in enumerate(csv_reader):
+    # in the partitioned layout, load into a standalone table and swap each study's partition afterwards
+    table = models.GeneExpression.__tablename__
+    if loaders.is_partitioned():
+        table = loaders.load_table_name(aws_file_name)
+        if checkpoint['byte_offset'] == 0:
+            loaders.create_staging_table(engine, table)
 
-        batch.append(row)
+    # resume after the last committed block -- a file read to the end only has its studies left to publish
+    range_args = {}
+    if checkpoint['byte_offset'] > 0:
+        print(f"Resuming {aws_file_name} at byte {checkpoint['byte_offset']} (row {checkpoint['n_rows']})")
+        range_args['Range'] = f"bytes={checkpoint['byte_offset']}-"
 
-        if len(batch) == batch_size:
-            engine.execute(
-                insert(models.GeneExpression,
-                       batch
-                       )
-            )
-            batch = []
-    # insert the last batch (needed if leftover < batch_size)
-    if len(batch) > 0:
-        engine.execute(
-            insert(models.GeneExpression,
-                   batch
-                   )
+    if checkpoint['byte_offset'] > 0 and checkpoint['byte_offset'] >= s3_client.head_object(Bucket=bucket, Key=aws_file_name)['ContentLength']:
+        stats = loaders.load_stats(0, 0)
+    else:
+        # get a file response
+        response = s3_client.get_object(Bucket=bucket, Key=aws_file_name, **range_args)
+
+        # stream the file into the database one block at a time
+        stats = loaders.load_expression_stream(engine,
+                                               response['Body'],
+                                               method=method,
+                                               table=table,
+                                               upsert=upsert and not loaders.is_partitioned(),
+                                               checkpoint=checkpoint)
+        print(f"Loaded {stats['rows']} rows in {stats['seconds']}s ({stats['rows_per_second']} rows/s)")
+
+    # a resumed load only read part of the file, so take the studies from the checkpoint
+    stats['accessions'] = checkpoint['accessions']
+
+    if loaders.is_partitioned():
+        stats['accessions'] = loaders.swap_study_partitions(engine, [table], checkpoint['columns'])
+
+    # flag and recount only the studies in this file
+    loaders.refresh_study_data(engine, stats['accessions'])
+
+    # the file counts as loaded only once its rows are visible and its studies refreshed
+    loaders.finish_checkpoint(engine, checkpoint)
+
+    if loaders.is_partitioned():
+        with engine.begin() as conn:
+            conn.exec_driver_sql(f"drop table {table}")
+
+    return {'status': True, **stats}
+
+
+@celery.task(name="add_gene_expression_data_part")
+def ingest_gene_expression_part(aws_file_name: str, staging: str, start: int, end: int, columns: list, method: str = 'copy'):
+    """Load one byte range of a gene expression file -- see ingest_gene_expression_data_parallel"""
+    return load_expression_range(aws_file_name, staging, start, end, columns, method)
+
+
+@celery.task(name="merge_gene_expression_parts")
+def merge_gene_expression_parts(part_stats: list, aws_file_name: str, staging_tables: list, columns: list):
+    """Merge the staging tables of a range-partitioned load into gene_expression
+
+    Args:
+        part_stats (list): Results of the part tasks
+        aws_file_name (str): Key of the loaded file
+        staging_tables (list): Staging tables to merge and drop
+        columns (list): Column names in file order
+
+    Returns:
+        dict: Task status and load statistics
+    """
+    engine = get_engine()
+
+    start = time.perf_counter()
+    n_rows = sum(p['rows'] for p in part_stats)
+    accessions = set(a for p in part_stats for a in p['accessions'])
+
+    if loaders.is_partitioned():
+        loaders.swap_study_partitions(engine, staging_tables, columns)
+    else:
+        loaders.merge_staging_tables(engine, staging_tables, columns)
+
+    loaders.refresh_study_data(engine, accessions)
+
+    # record the file as loaded so the serial task does not load it again
+    loaders.finish_checkpoint(engine, {'aws_file_name': aws_file_name,
+                                       'columns': columns,
+                                       'byte_offset': 0,
+                                       'n_rows': n_rows,
+                                       'accessions': sorted(accessions)})
+
+    if loaders.is_partitioned():
+        loaders.drop_staging_tables(engine, staging_tables)
+
+    # parts run concurrently, so the slowest part is the load time
+    seconds = max([p['seconds'] for p in part_stats], default=0) + time.perf_counter() - start
+    stats = loaders.load_stats(n_rows, seconds, accessions)
+    print(f"Loaded {stats['rows']} rows in {stats['seconds']}s ({stats['rows_per_second']} rows/s)")
+
+    return {'status': True, **stats}
+
+
+@celery.task(name="drop_gene_expression_parts")
+def drop_gene_expression_parts(request, exc, traceback, staging_tables: list):
+    """Error callback of merge_gene_expression_parts -- drop the staging tables of a failed load
+
+    A part that fails fails the chord, so this also runs when the merge never starts.
+
+    Args:
+        request (Context): Request of the failed task
+        exc (Exception): The error
+        traceback (str): Its traceback
+        staging_tables (list): Staging tables of the load
+    """
+    loaders.drop_staging_tables(get_engine(), staging_tables)
+    print(f"Dropped {len(staging_tables)} staging tables of a failed load: {exc!r}")
+
+
+@celery.task(bind=True, name="add_gene_expression_data_parallel")
+def ingest_gene_expression_data_parallel(self, aws_file_name: str, n_parts: int = 4, executor: str = 'celery', method: str = 'copy'):
+    """Load a gene expression file from S3 in parallel byte ranges
+
+    The file is split into n_parts ranges aligned to line boundaries. Each range is
+    loaded into its own index-free staging table, then the staging tables are merged
+    into gene_expression with upserts.
+
+    Args:
+        aws_file_name (str): Key of a CSV file in AWS_BUCKET
+        n_parts (int, optional): Number of ranges. Defaults to 4.
+        executor (str, optional): 'celery' to fan the ranges out as a chord of tasks, or 'local' to
+            load them in a process pool (needs a worker started with --pool=solo or threads). Defaults to 'celery'.
+        method (str, optional): 'copy' or 'executemany'. Defaults to 'copy'.
+
+    Returns:
+        dict: Task status, and either the merge task ID ('celery') or load statistics ('local')
+    """
+    if executor not in ('celery', 'local'):
+        raise ValueError(f"Unknown executor '{executor}'")
+
+    engine = get_engine()
+    s3_client = get_s3_client()
+    bucket = os.environ.get('AWS_BUCKET')
+
+    size = s3_client.head_object(Bucket=bucket, Key=aws_file_name)['ContentLength']
+
+    # the header is needed for column order and to find where the data starts
+    head = s3_client.get_object(Bucket=bucket, Key=aws_file_name, Range='bytes=0-65535')['Body'].read()
+    header = head.split(b'\n', 1)[0]
+    columns = loaders.parse_expression_header(header)
+
+    ranges = loaders.plan_byte_ranges(len(header) + 1, size, n_parts)
+
+    token = uuid.uuid4().hex[:8]
+    staging_tables = [f"{models.GeneExpression.__tablename__}_part_{token}_{i}" for i in range(len(ranges))]
+    for staging in staging_tables:
+        loaders.create_staging_table(engine, staging)
+
+    if executor == 'celery':
+        parts = group(
+            ingest_gene_expression_part.s(aws_file_name, staging, start, end, columns, method)
+            for staging, (start, end) in zip(staging_tables, ranges)
         )
+        merge = merge_gene_expression_parts.s(aws_file_name, staging_tables, columns).on_error(
+            drop_gene_expression_parts.s(staging_tables=staging_tables))
+        job = chord(parts)(merge)
+        return {'status': True, 'task_id': job.id}
+
+    try:
+        with ProcessPoolExecutor(max_workers=len(ranges), initializer=init_worker_engine) as pool:
+            part_stats = list(pool.map(load_expression_range,
+                                       [aws_file_name] * len(ranges),
+                                       staging_tables,
+                                       [r[0] for r in ranges],
+                                       [r[1] for r in ranges],
+                                       [columns] * len(ranges),
+                                       [method] * len(ranges)))
+
+        return merge_gene_expression_parts(part_stats, aws_file_name, staging_tables, columns)
+    finally:
+        # a successful merge has dropped them already
+        loaders.drop_staging_tables(engine, staging_tables)
+
+
+@celery.task(base=DatabaseTask, bind=True, name="build_download_archive")
+def build_download_archive(self, query: dict, format: str = 'csv'):
+    """Build the download archive for a data query in the background
+
+    The archive is written to the archive cache. If DOWNLOAD_BUCKET is set it is
+    uploaded to S3, so it can be fetched through a presigned link from any host.
+    Otherwise it is pinned in the cache until it is fetched, which needs a cache
+    directory shared with the API, see ARCHIVE_CACHE_SHARED.
+
+    Args:
+        query (dict): A schemas.DataQuery of selected studies and filters
+        format (str, optional): 'csv', 'parquet', 'feather' or 'hdf5'. Defaults to 'csv'.
 
-    populate_has_data_cmd = """
-    update studies set has_data = 1 
-    where external_db_id in (select distinct study_accession from gene_expression)
+    Returns:
+        dict: Task status, the archive cache key and, if uploaded, its S3 key
     """
+    cache = archives.ArchiveCache()
+    query = schemas.DataQuery.parse_obj(query)
+    key = archives.archive_key(self.db, query, format)
 
-    engine.execute(populate_has_data_cmd)
+    # pin a cached archive before checking for it, so it cannot be evicted in between
+    cache.pin(key)
+    archive_fp = cache.get(key)
+    if archive_fp is None:
+        # drain the stream into the cache
+        for _ in cache.store(key, archives.iter_download_archive(query, format, bind=get_engine()), pin=True):
+            pass
+        archive_fp = cache.path(key)
+
+    result = {'status': True, 'key': key}
+
+    bucket = os.environ.get('DOWNLOAD_BUCKET')
+    if bucket:
+        s3_key = f"downloads/{key}.zip"
+        try:
+            get_s3_client().upload_file(archive_fp, bucket, s3_key)
+        finally:
+            cache.unpin(key)
+        result['s3_key'] = s3_key
+
+    return result
+
+
+@celery.task(name="refresh_study_data_summary")
+def refresh_study_data_summary():
+    """Recount rows and samples for every study with expression data
+
+    Returns:
+        dict: Task status and the number of studies refreshed
+    """
+    engine = get_engine()
+
+    n_studies = loaders.rebuild_study_data_summary(engine)
+
+    return {'status': True, 'studies': n_studies}
+
+
+@celery.task(name="delete_gene_expression_study")
+def delete_gene_expression_study(accession_number: str):
+    """Delete the expression data of one study
+
+    In the partitioned layout this drops the study's partition instead of deleting rows.
+
+    Args:
+        accession_number (str): Accession of the study
+
+    Returns:
+        dict: Task status and whether the study had data
+    """
+    engine = get_engine()
+
+    deleted = loaders.delete_study_expression(engine, accession_number)
+
+    loaders.refresh_study_data(engine, [accession_number])
+
+    return {'status': True, 'deleted': deleted}
 
-    return {'status': True}
+
+@celery.task(name="partition_gene_expression")
+def partition_gene_expression(drop_source: bool = False):
+    """Move an existing gene_expression table into the partitioned layout, one partition per study
+
+    Run it with ingestion stopped. Running it again after a failure resumes the move.
+
+    Args:
+        drop_source (bool, optional): Drop the old table once every study is moved. Defaults to False.
+
+    Returns:
+        dict: Task status, the name of the old table, the number of studies moved and the number skipped
+    """
+    engine = get_engine()
+
+    stats = loaders.partition_expression_table(engine, drop_source=drop_source)
+
+    return {'status': True, **stats}
+
+
+@celery.task(name="migrate_gene_expression_storage")
+def migrate_gene_expression_storage(drop_source: bool = False):
+    """Copy gene_expression rows into the compact float4 / dictionary-key layout
+
+    Args:
+        drop_source (bool, optional): Delete each study from gene_expression once copied. Defaults to False.
+
+    Returns:
+        dict: Task status and the number of studies and rows migrated
+    """
+    engine = get_engine()
+
+    stats = loaders.migrate_expression_storage(engine, drop_source=drop_source)
+
+    return {'status': True, **stats}
 
 
 @celery.task(base=DatabaseTask, bind=True, name="add_metadata")
@@ -139,6 +504,7 @@ def ingest_gene_expression_metadata(self, query):
             insert(models.Study),
             parser.export_study_metadata()
         )
+        cache.bump_data_version(conn, cache.STUDIES)
 
     return {'status': True}
 
@@ -170,7 +536,7 @@ def ingest_gene_expression_sample_metadata(self):
     sample_meta = get_sample_metadata(gse_ids)
 
     print("starting")
-    engine = create_engine(os.environ.get('SQLALCHEMY_DATABASE_URL'))
+    engine = get_engine()
     for i, meta in enumerate(sample_meta):
         print(f"Inserting batch {i}")
         engine.execute(
@@ -180,4 +546,38 @@ def ingest_gene_expression_sample_metadata(self):
             )
         )
 
+        # keep the wide per-sample documents in sync with the new rows
+        loaders.refresh_sample_documents(engine, {m['accession_number'] for m in meta})
+
     return {'status': True}
+
+
+@celery.task(name="rebuild_sample_documents")
+def rebuild_sample_documents():
+    """Build per-sample metadata documents for every study with sample metadata
+
+    Returns:
+        dict: Task status and the number of documents written
+    """
+    engine = get_engine()
+
+    with engine.connect() as conn:
+        accessions = [r[0] for r in conn.execute(select(models.Sample.accession_number.distinct()))]
+
+    n_documents = loaders.refresh_sample_documents(engine, accessions)
+
+    return {'status': True, 'documents': n_documents}
+
+
+@celery.task(name="upgrade_schema")
+def upgrade_schema():
+    """Apply pending schema migrations, building missing indexes without blocking writes
+
+    Returns:
+        dict: Task status and the migration versions applied
+    """
+    engine = get_engine()
+
+    versions = migrations.upgrade(engine)
+
+    return {'status': True, 'applied': versions}